@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 16:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0006_seed_role_groups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='directory_fingerprint',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+    ]
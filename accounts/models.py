@@ -34,6 +34,8 @@ class User(AbstractUser):
     email_domain = models.CharField(max_length=128, blank=True, null=True)
     licenses = models.JSONField(default=list, blank=True)
     groups_cache = models.JSONField(default=list, blank=True)
+    # hash of the last directory payload synced into this row; unchanged payload = nothing to do
+    directory_fingerprint = models.CharField(max_length=32, blank=True, null=True)
 
     # auto-maintained by signals when a user has >=1 GuardianChild rows
     is_guardian = models.BooleanField(default=False)
@@ -1,19 +1,23 @@
+import json
+from django.conf import settings
 from django.contrib import admin, messages
+from django.http import HttpResponse
+from django.utils.html import format_html
 from django.utils import timezone
-from .models import ExternalDirectory, SyncJob
-from .utils import enqueue_run_now, test_connection
+from .models import ExternalDirectory, SchedulerLeader, SyncJob
+from .utils import enqueue_run_now, plan_summary, plan_sync, synced_user_count, test_connection, write_plan_csv
 from django.db import models as dj_models
 
 @admin.register(ExternalDirectory)
 class ExternalDirectoryAdmin(admin.ModelAdmin):
     list_display = ("name","provider","is_enabled","schedule_kind","interval_minutes","cron_expr","last_run_at","next_run_at","last_status")
     list_filter = ("provider","is_enabled","schedule_kind","last_status")
-    readonly_fields = ("last_run_at","next_run_at","last_status","last_error")
+    readonly_fields = ("last_run_at","next_run_at","last_status","last_error","graph_subscriptions","lease_owner","lease_expires_at")
     formfield_overrides = {
         dj_models.TextField: {"widget": admin.widgets.AdminTextareaWidget(attrs={"rows":2})},
     }
 
-    actions = ["action_run_now","action_test_connection","action_pause","action_resume"]
+    actions = ["action_run_now","action_test_connection","action_plan","action_pause","action_resume"]
 
     @admin.action(description="Run sync now (enqueue)")
     def action_run_now(self, request, queryset):
@@ -36,6 +40,36 @@ class ExternalDirectoryAdmin(admin.ModelAdmin):
         level = messages.SUCCESS if errs == 0 else messages.WARNING
         self.message_user(request, msg, level=level)
 
+    @admin.action(description="Dry run: plan sync (download change list)")
+    def action_plan(self, request, queryset):
+        # the whole tenant is listed inside this request: big ones would hit the worker timeout
+        max_users = getattr(settings, "DIRECTORY_SYNC_ADMIN_PLAN_MAX_USERS", 5000)
+        plans = []
+        for d in queryset:
+            size = synced_user_count(d)
+            if size > max_users:
+                self.message_user(
+                    request,
+                    f"{d.name}: {size} synced users is too many for a dry run in the browser "
+                    f"(limit {max_users}); run `manage.py plan_directory_sync {d.pk}` instead.",
+                    level=messages.WARNING,
+                )
+                continue
+            try:
+                plan = plan_sync(d)
+            except Exception as e:
+                self.message_user(request, f"{d.name}: dry run failed: {e}", level=messages.ERROR)
+                continue
+            self.message_user(request, plan_summary(d, plan), level=messages.INFO)
+            plans.append((d, plan))
+        if not plans:
+            return None
+        # the summaries above show on the next page load; the change list downloads now
+        response = HttpResponse(content_type="text/csv")
+        response["Content-Disposition"] = f'attachment; filename="directory-sync-plan-{timezone.now():%Y%m%d-%H%M}.csv"'
+        write_plan_csv(response, plans)
+        return response
+
     @admin.action(description="Pause (disable)")
     def action_pause(self, request, queryset):
         updated = queryset.update(is_enabled=False)
@@ -48,6 +82,21 @@ class ExternalDirectoryAdmin(admin.ModelAdmin):
 
 @admin.register(SyncJob)
 class SyncJobAdmin(admin.ModelAdmin):
-    list_display = ("directory","status","started_at","finished_at","created_count","updated_count","deactivated_count")
+    list_display = ("directory","status","started_at","finished_at","created_count","updated_count","deactivated_count","skipped_count","duration_seconds","http_calls","http_p95_ms","throttle_wait_seconds","db_queries")
     list_filter = ("status","directory__provider")
-    readonly_fields = ("directory","status","started_at","finished_at","created_count","updated_count","deactivated_count","notes")
+    readonly_fields = ("directory","status","started_at","finished_at","created_count","updated_count","deactivated_count","skipped_count","throttle_wait_seconds",
+                       "duration_seconds","pages_fetched","http_calls","http_bytes","http_p50_ms","http_p95_ms","db_queries","db_seconds","metrics_breakdown","notes")
+    exclude = ("metrics",)
+
+    @admin.display(description="Metrics")
+    def metrics_breakdown(self, obj):
+        # calls by endpoint, phase timings, ... as indented JSON
+        return format_html("<pre>{}</pre>", json.dumps(obj.metrics or {}, indent=2, sort_keys=True))
+
+@admin.register(SchedulerLeader)
+class SchedulerLeaderAdmin(admin.ModelAdmin):
+    list_display = ("name","owner","heartbeat_at","expires_at")
+    readonly_fields = ("name","owner","heartbeat_at","expires_at")
+
+    def has_add_permission(self, request):
+        return False
@@ -0,0 +1,301 @@
+"""
+Local stand-in for the slice of Google OAuth + the Admin SDK Directory API that
+GoogleSyncer talks to, for tests and benchmarks without a real Workspace.
+
+    fake = FakeGoogle(users=10_000, latency_ms=20, throttle_rate=0.01).start()
+    directory.credentials = fake.credentials()   # service_account / api_base / ca_bundle
+    ...
+    fake.stop()
+
+Same conventions as directory_sync.fakegraph (HTTPS with a throw-away certificate,
+latency and 429 injection, mutate() for churn). Covers the JWT bearer token endpoint,
+users.list (maxResults, pageToken, customer/domain, `fields` masks), groups.list by
+userKey and multipart batch calls.
+"""
+import json, re, ssl, threading, time, uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from .fakegraph import DEPARTMENTS, TITLES, _self_signed_cert
+
+TOKEN = "fake-google-token"
+CUSTOMER_ID = "C0fake000"
+
+
+def parse_fields(mask):
+    """'a,b(c,d(e))' -> {"a": None, "b": {"c": None, "d": {"e": None}}}"""
+    tree, stack, name = {}, [], ""
+    node = tree
+    for ch in mask + ",":
+        if ch == "(":
+            node[name.strip()] = {}
+            stack.append(node)
+            node, name = node[name.strip()], ""
+        elif ch == ")":
+            if name.strip():
+                node[name.strip()] = None
+            node, name = stack.pop(), ""
+        elif ch == ",":
+            if name.strip():
+                node[name.strip()] = None
+            name = ""
+        else:
+            name += ch
+    return tree
+
+
+def apply_fields(value, tree):
+    """Keeps only the masked keys; lists are masked item by item."""
+    if tree is None:
+        return value
+    if isinstance(value, list):
+        return [apply_fields(v, tree) for v in value]
+    if isinstance(value, dict):
+        return {k: apply_fields(value[k], sub) for k, sub in tree.items() if k in value}
+    return value
+
+
+class FakeGoogle:
+    def __init__(self, users=1000, domain="example.edu", latency_ms=0, throttle_rate=0.0,
+                 retry_after=1, seed=0):
+        import random
+        self.domain = domain
+        self.tenant_id = CUSTOMER_ID  # what GoogleSyncer stores in User.tenant_id
+        self.latency_ms = latency_ms
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.calls = Counter()  # endpoint label -> requests (batch parts counted as "batch:<label>")
+        self.throttled = 0
+        self.users = []
+        self.by_id = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self.certfile = None
+        for _ in range(users):
+            self._add_user()
+
+    # --- synthetic directory ---
+    def _add_user(self):
+        i = len(self.users)
+        uid = str(100000000000000000000 + i)
+        rec = {
+            "id": uid,
+            "primaryEmail": f"user{i:06d}@{self.domain}",
+            "customerId": CUSTOMER_ID,
+            "name": {"givenName": "User", "familyName": f"{i:06d}", "fullName": f"User {i:06d}"},
+            "suspended": i % 20 == 19,
+            "archived": False,
+            "isAdmin": False,
+            "orgUnitPath": "/",
+            "etag": f'"{uuid.uuid4().hex}"',
+            "organizations": [{
+                "title": TITLES[i % len(TITLES)],
+                "department": DEPARTMENTS[i % len(DEPARTMENTS)],
+                "primary": True,
+            }],
+            "_groups": [f"group{i % 10:02d}", f"dept-{DEPARTMENTS[i % len(DEPARTMENTS)].lower()}"],
+            "_deleted": False,
+        }
+        # every 25th user heads a team of 25 and has no manager themselves
+        if i % 25:
+            rec["relations"] = [{"type": "manager", "value": f"user{(i // 25) * 25:06d}@{self.domain}"}]
+        self.users.append(rec)
+        self.by_id[uid] = rec
+        return rec
+
+    def mutate(self, changed=0, removed=0, added=0):
+        """Simulates directory churn: new titles, deleted users, new users."""
+        with self._lock:
+            live = [u for u in self.users if not u["_deleted"]]
+            picked = self.random.sample(live, min(changed + removed, len(live)))
+            for u in picked[:changed]:
+                u["organizations"][0]["title"] = self.random.choice(TITLES) + " II"
+                u["etag"] = f'"{uuid.uuid4().hex}"'
+            for u in picked[changed:]:
+                u["_deleted"] = True
+            for _ in range(added):
+                self._add_user()
+
+    # --- server lifecycle ---
+    def start(self, host="127.0.0.1", port=0):
+        self.certfile, keyfile = _self_signed_cert()
+        fake = self
+
+        class Handler(_Handler):
+            google = fake
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ctx.load_cert_chain(self.certfile, keyfile)
+        self._server.socket = ctx.wrap_socket(self._server.socket, server_side=True)
+        threading.Thread(target=self._server.serve_forever, daemon=True, name="fakegoogle").start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"https://{host}:{port}"
+
+    def credentials(self):
+        """ExternalDirectory.credentials that point GoogleSyncer at this server."""
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        pem = key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption(),
+        ).decode()
+        return {
+            "service_account": {
+                "type": "service_account",
+                "client_email": "directory-sync@fake-project.iam.gserviceaccount.com",
+                "private_key": pem,
+                "token_uri": f"{self.base_url}/token",
+            },
+            "subject": f"admin@{self.domain}",
+            "customer": "my_customer",
+            "api_base": self.base_url,
+            "ca_bundle": self.certfile,
+        }
+
+    # --- request handling (shared by plain requests and batch parts) ---
+    def _maybe_throttle(self):
+        if self.throttle_rate and self.random.random() < self.throttle_rate:
+            with self._lock:
+                self.throttled += 1
+            return 429, {"error": {"code": 429, "message": "Rate limit exceeded (fake)",
+                                   "errors": [{"reason": "rateLimitExceeded"}]}}, {
+                "Retry-After": str(self.retry_after)}
+        return None
+
+    def _count(self, label):
+        with self._lock:
+            self.calls[label] += 1
+
+    def handle(self, method, path, query, in_batch=False):
+        """Returns (status, json body, headers) for one Directory API call."""
+        label = re.sub(r"/users/[^/]+$", "/users/{id}", path).rsplit("/v1", 1)[-1]
+        self._count(("batch:" if in_batch else "") + label)
+        throttled = self._maybe_throttle()
+        if throttled:
+            return throttled
+        q = {k: v[0] for k, v in query.items()}
+        fields = parse_fields(q["fields"]) if q.get("fields") else None
+
+        if path == "/admin/directory/v1/users" and method == "GET":
+            if not (q.get("customer") or q.get("domain")):
+                return 400, {"error": {"code": 400, "message": "Bad Request"}}, {}
+            rows = [u for u in self.users if not u["_deleted"]]
+            if q.get("domain"):
+                rows = [u for u in rows if u["primaryEmail"].endswith("@" + q["domain"])]
+            body = self._page(rows, q, "users", max_results=500)
+        elif path == "/admin/directory/v1/groups" and method == "GET":
+            rec = self.by_id.get(q.get("userKey", ""))
+            if rec is None or rec["_deleted"]:
+                return 404, {"error": {"code": 404, "message": "Resource Not Found: userKey"}}, {}
+            groups = [{"kind": "admin#directory#group", "id": g, "email": f"{g}@{self.domain}",
+                       "name": g} for g in rec["_groups"]]
+            body = self._page(groups, q, "groups", max_results=200)
+        else:
+            return 404, {"error": {"code": 404, "message": f"fake has no {method} {path}"}}, {}
+        return 200, apply_fields(body, fields), {}
+
+    def _page(self, rows, q, key, max_results):
+        top = min(int(q.get("maxResults", 100)), max_results)
+        offset = int(q.get("pageToken", 0))
+        body = {"kind": f"admin#directory#{key}", key: [
+            {k: v for k, v in r.items() if not k.startswith("_")} for r in rows[offset:offset + top]
+        ]}
+        if offset + top < len(rows):
+            body["nextPageToken"] = str(offset + top)
+        return body
+
+    def batch(self, content_type, raw):
+        """Answers a multipart/mixed batch; returns (content type, body bytes)."""
+        boundary = content_type.split("boundary=", 1)[1].strip().strip('"')
+        out_boundary = f"batch_{uuid.uuid4().hex}"
+        parts = []
+        for part in raw.decode("utf-8").split(f"--{boundary}"):
+            part = part.strip()
+            if not part or part == "--":
+                continue
+            outer, _, inner = part.partition("\r\n\r\n")
+            cid = ""
+            for line in outer.splitlines():
+                if line.lower().startswith("content-id:"):
+                    cid = line.split(":", 1)[1].strip().strip("<>")
+            request_line = inner.strip().splitlines()[0]
+            method, target = request_line.split()[:2]
+            u = urlparse(target)
+            status, payload, headers = self.handle(method, u.path, parse_qs(u.query), in_batch=True)
+            extra = "".join(f"{k}: {v}\r\n" for k, v in headers.items())
+            parts.append(
+                f"--{out_boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{cid}>\r\n\r\n"
+                f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                f"Content-Type: application/json; charset=UTF-8\r\n{extra}\r\n{json.dumps(payload)}\r\n"
+            )
+        body = "".join(parts) + f"--{out_boundary}--\r\n"
+        return f"multipart/mixed; boundary={out_boundary}", body.encode()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    google = None  # set on the per-server subclass
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body, headers=None, content_type="application/json; charset=UTF-8"):
+        raw = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(raw)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def _body(self):
+        n = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(n) if n else b""
+
+    def _dispatch(self, method):
+        g = self.google
+        if g.latency_ms:
+            time.sleep(g.latency_ms / 1000)
+        u = urlparse(self.path)
+        raw = self._body()
+
+        # OAuth 2.0 JWT bearer grant: any well-formed service account assertion is accepted
+        if u.path == "/token" and method == "POST":
+            form = {k: v[0] for k, v in parse_qs(raw.decode()).items()}
+            if form.get("grant_type") != "urn:ietf:params:oauth:grant-type:jwt-bearer" or not form.get("assertion"):
+                return self._send(400, {"error": "invalid_grant"})
+            g._count("token")
+            return self._send(200, {"access_token": TOKEN, "expires_in": 3599, "token_type": "Bearer"})
+
+        if self.headers.get("Authorization") != f"Bearer {TOKEN}":
+            return self._send(401, {"error": {"code": 401, "message": "Invalid Credentials"}})
+        if u.path == "/batch/admin/directory_v1" and method == "POST":
+            g._count("batch")
+            throttled = g._maybe_throttle()
+            if throttled:
+                return self._send(*throttled)
+            content_type, body = g.batch(self.headers.get("Content-Type", ""), raw)
+            return self._send(200, body, content_type=content_type)
+        status, payload, headers = g.handle(method, u.path, parse_qs(u.query))
+        self._send(status, payload, headers)
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
@@ -0,0 +1,527 @@
+"""
+Local stand-in for the slice of Entra ID + Microsoft Graph that AzureSyncer talks to,
+for load tests and benchmarks without a real tenant.
+
+    fake = FakeGraph(users=10_000, latency_ms=20, throttle_rate=0.01).start()
+    directory.credentials = fake.credentials()   # authority_host / graph_base / ca_bundle
+    ...
+    fake.stop()
+
+Served over HTTPS with a throw-away self-signed certificate (MSAL only accepts https
+authorities); credentials() points ca_bundle at it. Covers the token endpoint + OIDC
+metadata, users/delta (paging, delta links, $deltatoken=latest, @removed entries,
+manager@delta when "manager" is selected), /users with $expand=manager and
+userPrincipalName ge/le filters, subscribedSkus, manager, licenseDetails,
+getMemberGroups, groups/delta (membership changes of added, removed and regrouped users
+after a cursor) and $batch. Every request can be delayed (latency_ms) and a share of them
+answered with 429 + Retry-After (throttle_rate / retry_after). Collections put
+@odata.context and the next/delta links before "value", in the order Graph sends them.
+
+Change notifications: POST /subscriptions rejects changeTypes Graph does not support for
+the resource and runs Graph's validationToken handshake against the notificationUrl
+(PATCH renews, DELETE removes), and mutate() then posts a notification batch to every
+users subscription (groups subscriptions for membership changes), like Graph does;
+notify() sends one on demand.
+"""
+import datetime, ipaddress, json, os, random, re, ssl, tempfile, threading, time, uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+TOKEN = "fake-graph-token"
+# changeTypes Graph accepts per subscription resource
+CHANGE_TYPES = {"users": {"updated", "deleted"}, "groups": {"updated", "deleted"}}
+SKUS = [
+    ("6fd2c87f-b296-42f0-b197-1e91e994b900", "STANDARDWOFFPACK_FACULTY"),
+    ("314c4481-f395-4525-be8b-2ec4bb1e9d91", "STANDARDWOFFPACK_STUDENT"),
+    ("94763226-9b3c-4e75-a931-5c89701abe66", "POWER_BI_STANDARD"),
+]
+DEPARTMENTS = ["Primary", "Secondary", "Administration", "Finance", "IT", "Admissions"]
+TITLES = ["Teacher", "Student", "Coordinator", "Assistant", "Officer"]
+# one given name per initial, so userPrincipalNames spread over the alphabet like a real tenant's
+GIVEN_NAMES = [
+    "Amira", "Bilal", "Carmen", "Dana", "Elif", "Farid", "Goran", "Hana", "Idris", "Jana", "Karim", "Lina",
+    "Maya", "Nour", "Omar", "Petra", "Qasim", "Rana", "Sami", "Tara", "Umar", "Vera", "Walid", "Xenia",
+    "Yara", "Zaid",
+]
+
+
+def _self_signed_cert():
+    """Writes a short-lived cert/key for localhost + 127.0.0.1; returns (certfile, keyfile)."""
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name).issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=5))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(x509.SubjectAlternativeName([
+            x509.DNSName("localhost"), x509.IPAddress(ipaddress.ip_address("127.0.0.1")),
+        ]), critical=False)
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+    folder = tempfile.mkdtemp(prefix="fakegraph-")
+    certfile, keyfile = os.path.join(folder, "cert.pem"), os.path.join(folder, "key.pem")
+    with open(certfile, "wb") as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(keyfile, "wb") as f:
+        f.write(key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption(),
+        ))
+    return certfile, keyfile
+
+
+class FakeGraph:
+    def __init__(self, users=1000, domain="example.edu", latency_ms=0, throttle_rate=0.0,
+                 retry_after=1, tenant_id=None, seed=0):
+        self.tenant_id = tenant_id or str(uuid.uuid4())
+        self.domain = domain
+        self.latency_ms = latency_ms
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.calls = Counter()  # endpoint label -> requests (batch sub-requests counted as "batch:<label>")
+        self.throttled = 0
+        self.version = 1  # bumped by every mutate(); delta tokens are versions
+        self.users = []  # records in creation order; deleted ones stay with deleted=True
+        self.by_id = {}
+        self.subscriptions = {}  # id -> subscription as created through POST /subscriptions
+        self.memberships = []  # (version, group, user id, removed) for groups/delta rounds
+        self.notified = []  # HTTP status of every notification batch delivered
+        self._lock = threading.Lock()
+        self._server = None
+        self.certfile = None
+        for _ in range(users):
+            self._add_user()
+
+    # --- synthetic directory ---
+    def _add_user(self):
+        i = len(self.users)
+        given = GIVEN_NAMES[i % len(GIVEN_NAMES)]
+        oid = str(uuid.uuid5(uuid.NAMESPACE_URL, f"{self.tenant_id}/{i}"))
+        rec = {
+            "id": oid,
+            "mail": f"{given.lower()}.{i:06d}@{self.domain}",
+            "userPrincipalName": f"{given.lower()}.{i:06d}@{self.domain}",
+            "givenName": given,
+            "surname": f"{i:06d}",
+            "displayName": f"{given} {i:06d}",
+            "jobTitle": TITLES[i % len(TITLES)],
+            "department": DEPARTMENTS[i % len(DEPARTMENTS)],
+            "accountEnabled": i % 20 != 19,
+            "assignedLicenses": [{"skuId": SKUS[i % len(SKUS)][0], "disabledPlans": []}],
+            # every 25th user heads a team of 25 and has no manager themselves
+            "_manager": None if i % 25 == 0 else (i // 25) * 25,
+            "_manager_v": self.version,
+            "_groups": [f"group-{i % 10:02d}", f"dept-{DEPARTMENTS[i % len(DEPARTMENTS)].lower()}"],
+            "_v": self.version,
+            "_deleted": False,
+        }
+        self.users.append(rec)
+        self.by_id[oid] = rec
+        self.memberships += [(self.version, g, oid, False) for g in rec["_groups"]]
+        return rec
+
+    def mutate(self, changed=0, removed=0, added=0, reassigned=0, regrouped=0):
+        """
+        Simulates directory churn; the next delta round returns exactly these users.
+        `reassigned` users move to another team (a new manager@delta), `regrouped` ones to
+        another group-NN (reported by the next groups/delta round, like added and removed users).
+        """
+        changes = []  # (changeType, id) for subscribers
+        with self._lock:
+            self.version += 1
+            live = [u for u in self.users if not u["_deleted"]]
+            for u in self.random.sample(live, min(changed, len(live))):
+                u["jobTitle"] = self.random.choice(TITLES) + " II"
+                u["_v"] = self.version
+                changes.append(("updated", u["id"]))
+            live = [u for u in live if u["_v"] != self.version]
+            for u in self.random.sample(live, min(removed, len(live))):
+                u["_deleted"] = True
+                u["_v"] = self.version
+                self.memberships += [(self.version, g, u["id"], True) for g in u["_groups"]]
+                changes.append(("deleted", u["id"]))
+            for _ in range(added):
+                changes.append(("updated", self._add_user()["id"]))  # Graph has no "created" for users
+            leads = [u for u in self.users if u["_manager"] is None and not u["_deleted"]]
+            live = [u for u in self.users if u["_manager"] is not None and not u["_deleted"]]
+            for u in self.random.sample(live, min(reassigned, len(live))):
+                u["_manager"] = self.users.index(self.random.choice(leads))
+                u["_v"] = u["_manager_v"] = self.version
+                changes.append(("updated", u["id"]))
+            live = [u for u in self.users if not u["_deleted"]]
+            for u in self.random.sample(live, min(regrouped, len(live))):
+                old = u["_groups"][0]
+                new = f"group-{(int(old.split('-')[1]) + 1) % 10:02d}"
+                u["_groups"] = [new] + u["_groups"][1:]
+                self.memberships += [(self.version, old, u["id"], True), (self.version, new, u["id"], False)]
+            touched = {g for v, g, _, _ in self.memberships if v == self.version}
+        if changes and self.subscriptions:
+            self.notify(changes)
+        if touched and self.subscriptions:
+            self.notify([("updated", g) for g in sorted(touched)], resource="groups")
+
+    # --- change notifications ---
+    def notify(self, changes, resource="users"):
+        """
+        Posts one notification batch, [(changeType, id), ...], to every subscription on
+        `resource` whose changeType covers them. Returns the HTTP statuses (also kept in
+        `notified`); Graph expects a 2xx within a few seconds.
+        """
+        import requests
+
+        statuses = []
+        for sub in list(self.subscriptions.values()):
+            if sub["resource"] != resource:
+                continue
+            value = [
+                {
+                    "subscriptionId": sub["id"],
+                    "subscriptionExpirationDateTime": sub["expirationDateTime"],
+                    "clientState": sub.get("clientState"),
+                    "changeType": change_type,
+                    "resource": f"{resource.capitalize()}/{oid}",
+                    "tenantId": self.tenant_id,
+                    "resourceData": {"@odata.type": f"#Microsoft.Graph.{resource[:-1].capitalize()}", "id": oid},
+                }
+                for change_type, oid in changes if change_type in sub["changeType"].split(",")
+            ]
+            if value:
+                r = requests.post(sub["notificationUrl"], json={"value": value}, timeout=10)
+                statuses.append(r.status_code)
+        self.notified += statuses
+        return statuses
+
+    def _subscribe(self, body):
+        """POST /subscriptions: Graph only creates it once the notificationUrl echoes a validationToken."""
+        import requests
+
+        body = body or {}
+        missing = [k for k in ("changeType", "notificationUrl", "resource", "expirationDateTime") if not body.get(k)]
+        if missing:
+            return 400, {"error": {"code": "InvalidRequest", "message": f"missing {', '.join(missing)}"}}, {}
+        allowed = CHANGE_TYPES.get(body["resource"])
+        if allowed is None:
+            return 400, {"error": {"code": "InvalidRequest", "message": f"resource {body['resource']} not supported"}}, {}
+        unsupported = set(body["changeType"].split(",")) - allowed
+        if unsupported:
+            return 400, {"error": {"code": "InvalidRequest", "message": (
+                f"changeType {', '.join(sorted(unsupported))} is not supported for {body['resource']}"
+            )}}, {}
+        token = uuid.uuid4().hex
+        try:
+            r = requests.post(body["notificationUrl"], params={"validationToken": token}, timeout=10)
+            ok = r.status_code == 200 and r.text == token
+        except requests.RequestException:
+            ok = False
+        if not ok:
+            return 400, {"error": {"code": "ValidationError",
+                                   "message": "Subscription validation request failed."}}, {}
+        sub = {k: body.get(k) for k in ("changeType", "notificationUrl", "resource", "expirationDateTime", "clientState")}
+        sub["id"] = str(uuid.uuid4())
+        with self._lock:
+            self.subscriptions[sub["id"]] = sub
+        return 201, sub, {}
+
+    def _public(self, rec, select=None):
+        keys = select or [k for k in rec if not k.startswith("_") and k != "assignedLicenses"]
+        return {k: rec.get(k) for k in keys if not k.startswith("_")}
+
+    # --- server lifecycle ---
+    def start(self, host="127.0.0.1", port=0):
+        self.certfile, keyfile = _self_signed_cert()
+        fake = self
+
+        class Handler(_Handler):
+            graph = fake
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ctx.load_cert_chain(self.certfile, keyfile)
+        self._server.socket = ctx.wrap_socket(self._server.socket, server_side=True)
+        threading.Thread(target=self._server.serve_forever, daemon=True, name="fakegraph").start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"https://{host}:{port}"
+
+    def credentials(self):
+        """ExternalDirectory.credentials that point AzureSyncer at this server."""
+        return {
+            "tenant_id": self.tenant_id,
+            "client_id": "fake-client",
+            "client_secret": "fake-secret",
+            "authority_host": self.base_url,
+            "graph_base": f"{self.base_url}/v1.0",
+            "ca_bundle": self.certfile,
+        }
+
+    # --- request handling (shared by plain requests and $batch items) ---
+    def _maybe_throttle(self):
+        if self.throttle_rate and self.random.random() < self.throttle_rate:
+            with self._lock:
+                self.throttled += 1
+            return 429, {"error": {"code": "TooManyRequests", "message": "Throttled (fake)"}}, {
+                "Retry-After": str(self.retry_after)}
+        return None
+
+    def _count(self, label):
+        with self._lock:
+            self.calls[label] += 1
+
+    def handle(self, method, path, query, body, in_batch=False):
+        """Returns (status, json body, headers) for one Graph call; path is relative to /v1.0."""
+        label = self._label(path)
+        self._count(("batch:" if in_batch else "") + label)
+        throttled = self._maybe_throttle()
+        if throttled:
+            return throttled
+
+        m = re.match(r"^/users/([^/]+)(?:/(manager|licenseDetails|getMemberGroups))?$", path)
+        if path == "/organization":
+            return 200, {"value": [{"id": self.tenant_id, "displayName": "Fake school"}]}, {}
+        if path == "/users/delta":
+            return self._users_delta(query)
+        if path == "/users":
+            return self._users_list(query)
+        if path == "/subscribedSkus":
+            return 200, {"value": [{"skuId": sid, "skuPartNumber": part} for sid, part in SKUS]}, {}
+        if path == "/groups/delta":
+            return self._groups_delta(query)
+        if path == "/subscriptions" and method == "POST":
+            return self._subscribe(body)
+        sm = re.match(r"^/subscriptions/([^/]+)$", path)
+        if sm:
+            sub = self.subscriptions.get(sm.group(1))
+            if sub is None:
+                return 404, {"error": {"code": "ResourceNotFound"}}, {}
+            if method == "DELETE":
+                self.subscriptions.pop(sub["id"], None)
+                return 204, None, {}
+            if method == "PATCH":
+                sub["expirationDateTime"] = (body or {}).get("expirationDateTime") or sub["expirationDateTime"]
+                return 200, sub, {}
+        if m:
+            rec = self.by_id.get(m.group(1))
+            if rec is None or rec["_deleted"]:
+                return 404, {"error": {"code": "Request_ResourceNotFound"}}, {}
+            kind = m.group(2)
+            if kind is None:
+                select = query.get("$select", [""])[0].split(",") if "$select" in query else None
+                return 200, self._public(rec, select), {}
+            if kind == "manager":
+                if rec["_manager"] is None:
+                    return 404, {"error": {"code": "Request_ResourceNotFound"}}, {}
+                return 200, self._public(self.users[rec["_manager"]]), {}
+            if kind == "licenseDetails":
+                parts = dict(SKUS)
+                return 200, {"value": [
+                    {"skuId": x["skuId"], "skuPartNumber": parts.get(x["skuId"])} for x in rec["assignedLicenses"]
+                ]}, {}
+            if kind == "getMemberGroups" and method == "POST":
+                return 200, {"value": list(rec["_groups"])}, {}
+        return 404, {"error": {"code": "NotFound", "message": f"fake has no {method} {path}"}}, {}
+
+    def _label(self, path):
+        path = re.sub(r"^/users/(?!delta$)[^/]+", "/users/{id}", path)
+        return path.strip("/") or "/"
+
+    def _page(self, rows, query, path):
+        """Slices rows for $top/$skiptoken; returns (page, next link or None)."""
+        top = int(query.get("$top", ["100"])[0])
+        offset = int(query.get("$skiptoken", ["0"])[0])
+        page = rows[offset:offset + top]
+        if offset + top >= len(rows):
+            return page, None
+        args = {k: v[0] for k, v in query.items()}
+        args["$skiptoken"] = str(offset + top)
+        return page, f"{self.base_url}/v1.0{path}?{urlencode(args)}"
+
+    def _collection(self, entity, value, next_link=None, delta_link=None):
+        """
+        A collection response with its members in Graph's order: @odata.context, then the
+        links, then "value" (so a client cannot rely on seeing the links last).
+        """
+        body = {"@odata.context": f"{self.base_url}/v1.0/$metadata#{entity}"}
+        if next_link:
+            body["@odata.nextLink"] = next_link
+        if delta_link:
+            body["@odata.deltaLink"] = delta_link
+        body["value"] = value
+        return body
+
+    def _users_delta(self, query):
+        select = query["$select"][0].split(",") if "$select" in query else None
+        with_manager = bool(select) and "manager" in select
+        fields = [k for k in select if k != "manager"] if select else None
+        if query.get("$deltatoken") == ["latest"]:
+            return 200, self._collection("users", [], delta_link=self._delta_link("/users/delta", select)), {}
+        since = int(query.get("$deltatoken", ["0"])[0])
+        if since:
+            rows = [u for u in self.users if u["_v"] > since]
+        else:
+            rows = [u for u in self.users if not u["_deleted"]]
+        page, next_link = self._page(rows, query, "/users/delta")
+        value = []
+        for u in page:
+            if u["_deleted"]:
+                value.append({"id": u["id"], "@removed": {"reason": "changed"}})
+                continue
+            item = self._public(u, fields)
+            # the relationship is reported on the initial round and whenever it changed
+            if with_manager and (u["_manager_v"] > since or not since):
+                if u["_manager"] is not None:
+                    item["manager@delta"] = [{"@odata.type": "#microsoft.graph.user", "id": self.users[u["_manager"]]["id"]}]
+                elif since:
+                    item["manager@delta"] = [{"id": "", "@removed": {"reason": "deleted"}}]
+            value.append(item)
+        delta_link = None if next_link else self._delta_link("/users/delta", select)
+        return 200, self._collection("users", value, next_link, delta_link), {}
+
+    def _delta_link(self, path, select=None):
+        args = {"$deltatoken": str(self.version)}
+        if select:
+            args["$select"] = ",".join(select)
+        return f"{self.base_url}/v1.0{path}?{urlencode(args)}"
+
+    def _users_list(self, query):
+        select = query["$select"][0].split(",") if "$select" in query else None
+        expand = query.get("$expand", [""])[0]
+        rows = [u for u in self.users if not u["_deleted"]]
+        # $filter: only "userPrincipalName ge|le '<value>'" clauses joined by "and"
+        for op, value in re.findall(r"userPrincipalName (ge|le) '([^']*)'", query.get("$filter", [""])[0]):
+            if op == "ge":
+                rows = [u for u in rows if u["userPrincipalName"].lower() >= value.lower()]
+            else:
+                rows = [u for u in rows if u["userPrincipalName"].lower() <= value.lower()]
+        page, next_link = self._page(rows, query, "/users")
+        value = []
+        for u in page:
+            item = self._public(u, select)
+            if expand.startswith("manager") and u["_manager"] is not None:
+                mgr = self.users[u["_manager"]]
+                item["manager"] = {"id": mgr["id"], "mail": mgr["mail"], "userPrincipalName": mgr["userPrincipalName"]}
+            value.append(item)
+        return 200, self._collection("users", value, next_link), {}
+
+    def _groups_delta(self, query):
+        if "$deltatoken" in query:
+            # the membership changes since the cursor: members@delta of each group touched
+            since = int(query["$deltatoken"][0])
+            members = {}
+            with self._lock:
+                changes = [m for m in self.memberships if m[0] > since]
+            for _, g, oid, removed in changes:
+                member = {"@odata.type": "#microsoft.graph.user", "id": oid}
+                if removed:
+                    member["@removed"] = {"reason": "deleted"}
+                members.setdefault(g, []).append(member)
+            value = [{"id": g, "members@delta": m} for g, m in sorted(members.items())]
+            return 200, self._collection("groups", value, delta_link=self._delta_link("/groups/delta")), {}
+        members = {}
+        for u in self.users:
+            if not u["_deleted"]:
+                for g in u["_groups"]:
+                    members.setdefault(g, []).append({"@odata.type": "#microsoft.graph.user", "id": u["id"]})
+        value = [{"id": g, "members@delta": m} for g, m in sorted(members.items())]
+        return 200, self._collection("groups", value, delta_link=self._delta_link("/groups/delta")), {}
+
+    def batch(self, body):
+        responses = []
+        for item in (body or {}).get("requests", [])[:20]:
+            u = urlparse(item.get("url", ""))
+            status, payload, headers = self.handle(
+                item.get("method", "GET"), u.path, parse_qs(u.query), item.get("body"), in_batch=True,
+            )
+            responses.append({"id": item.get("id"), "status": status, "headers": headers, "body": payload})
+        self.random.shuffle(responses)  # Graph does not promise any order either
+        return responses
+
+
+class _Handler(BaseHTTPRequestHandler):
+    graph = None  # set on the per-server subclass
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real service
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body, headers=None):
+        raw = b"" if status == 204 else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def _body(self):
+        n = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(n) if n else b""
+
+    def _dispatch(self, method):
+        g = self.graph
+        if g.latency_ms:
+            time.sleep(g.latency_ms / 1000)
+        u = urlparse(self.path)
+        query = parse_qs(u.query)
+        raw = self._body()
+
+        # Entra ID: OIDC metadata + client-credentials token
+        if u.path.endswith("/v2.0/.well-known/openid-configuration"):
+            tenant = u.path.split("/")[1]
+            return self._send(200, {
+                "authorization_endpoint": f"{g.base_url}/{tenant}/oauth2/v2.0/authorize",
+                "token_endpoint": f"{g.base_url}/{tenant}/oauth2/v2.0/token",
+                "issuer": f"{g.base_url}/{tenant}/v2.0",
+            })
+        if u.path.endswith("/oauth2/v2.0/token") and method == "POST":
+            g._count("token")
+            return self._send(200, {"token_type": "Bearer", "expires_in": 3599, "access_token": TOKEN})
+
+        if not u.path.startswith("/v1.0/"):
+            return self._send(404, {"error": {"code": "NotFound"}})
+        if self.headers.get("Authorization") != f"Bearer {TOKEN}":
+            return self._send(401, {"error": {"code": "InvalidAuthenticationToken"}})
+
+        path = u.path[len("/v1.0"):]
+        body = json.loads(raw) if raw else None
+        if path == "/$batch" and method == "POST":
+            g._count("$batch")
+            throttled = g._maybe_throttle()
+            if throttled:
+                return self._send(*throttled)
+            return self._send(200, {"responses": g.batch(body)})
+        status, payload, headers = g.handle(method, path, query, body)
+        self._send(status, payload, headers)
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_PATCH(self):
+        self._dispatch("PATCH")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
@@ -0,0 +1,117 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+from accounts.models import User
+from directory_sync.fakegoogle import FakeGoogle
+from directory_sync.fakegraph import FakeGraph
+from directory_sync.models import ExternalDirectory
+from directory_sync.utils import get_syncer
+
+
+class QueryCounter:
+    """connection.execute_wrapper hook: counts the SQL statements of the sync thread."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks the directory sync against a local fake Microsoft Graph "
+        "(directory_sync.fakegraph) or Google Admin SDK (directory_sync.fakegoogle). "
+        "For each size it runs an initial crawl and a delta round (a full re-listing for Google) "
+        "and reports users/sec, API calls per user and DB queries per user. "
+        "Writes synthetic users into the configured database and removes them afterwards; "
+        "use a scratch database for the large sizes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--provider", choices=["azure", "google"], default="azure")
+        parser.add_argument("--sizes", nargs="+", type=int, default=[10_000, 50_000, 100_000])
+        parser.add_argument("--latency-ms", type=int, default=0, help="Delay added to every fake Graph response.")
+        parser.add_argument("--throttle-rate", type=float, default=0.0,
+                            help="Share of requests answered with 429 (0..1).")
+        parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with injected 429s.")
+        parser.add_argument("--churn", type=float, default=0.01,
+                            help="Share of users changed before the delta round.")
+        parser.add_argument("--rate", type=float, default=1000,
+                            help="Client rate limit (calls/sec) for the fake tenant.")
+        parser.add_argument("--no-batch", action="store_true", help="Per-user calls instead of $batch.")
+        parser.add_argument("--no-expand", action="store_true",
+                            help="Initial crawl via users/delta instead of /users with $expand.")
+        parser.add_argument("--workers", type=int, default=4, help="Enrichment workers.")
+        parser.add_argument("--segments", type=int, default=1,
+                            help="UPN ranges the initial crawl lists in parallel (crawl_segments).")
+        parser.add_argument("--group-mode", choices=["per_user", "delta"], default="per_user")
+        parser.add_argument("--keep", action="store_true", help="Keep the synthetic users and directories.")
+
+    def handle(self, *args, **opts):
+        rows = []
+        with override_settings(DIRECTORY_SYNC_RATE_PER_SECOND=opts["rate"], DIRECTORY_SYNC_RATE_BURST=opts["rate"]):
+            for size in opts["sizes"]:
+                rows += self._bench(size, opts)
+
+        header = f"{'users':>8} {'phase':<8} {'changed':>8} {'seconds':>8} {'users/s':>9} " \
+                 f"{'calls':>7} {'calls/u':>8} {'queries':>8} {'q/u':>6} {'429s':>5}"
+        self.stdout.write(header)
+        for r in rows:
+            self.stdout.write(
+                f"{r['size']:>8} {r['phase']:<8} {r['users']:>8} {r['seconds']:>8.1f} {r['rate']:>9.0f} "
+                f"{r['calls']:>7} {r['calls_per_user']:>8.2f} {r['queries']:>8} {r['queries_per_user']:>6.2f} "
+                f"{r['throttled']:>5}"
+            )
+
+    def _bench(self, size, opts):
+        fake_cls = FakeGoogle if opts["provider"] == "google" else FakeGraph
+        fake = fake_cls(
+            users=size, latency_ms=opts["latency_ms"], throttle_rate=opts["throttle_rate"],
+            retry_after=opts["retry_after"],
+        ).start()
+        d = ExternalDirectory.objects.create(
+            name=f"Benchmark {size} users",
+            provider=opts["provider"],
+            is_enabled=False,  # the scheduler must not pick this one up
+            credentials=fake.credentials(),
+            batch_requests=not opts["no_batch"],
+            expand_full_crawl=not opts["no_expand"],
+            enrichment_workers=opts["workers"],
+            crawl_segments=opts["segments"],
+            group_sync_mode=opts["group_mode"],
+        )
+        results = []
+        try:
+            self.stdout.write(f"{size} users: initial crawl…")
+            results.append(self._run(d, fake, size, "initial", size))
+
+            changed = max(1, int(size * opts["churn"]))
+            fake.mutate(changed=changed, removed=changed // 10, added=changed // 10)
+            self.stdout.write(f"{size} users: delta round ({changed} changed)…")
+            results.append(self._run(d, fake, size, "delta", changed + 2 * (changed // 10)))
+        finally:
+            fake.stop()
+            if not opts["keep"]:
+                User.objects.filter(identity_source=opts["provider"].upper(), tenant_id=fake.tenant_id).delete()
+                d.delete()
+        return results
+
+    def _run(self, d, fake, size, phase, users):
+        fake.calls.clear()
+        fake.throttled = 0
+        counter = QueryCounter()
+        t0 = time.perf_counter()
+        with connection.execute_wrapper(counter):
+            get_syncer(d).sync()
+        seconds = time.perf_counter() - t0
+        calls = sum(n for label, n in fake.calls.items() if not label.startswith("batch:"))
+        return dict(
+            size=size, phase=phase, users=users, seconds=seconds,
+            rate=users / seconds if seconds else 0,
+            calls=calls, calls_per_user=calls / users if users else 0,
+            queries=counter.count, queries_per_user=counter.count / users if users else 0,
+            throttled=fake.throttled,
+        )
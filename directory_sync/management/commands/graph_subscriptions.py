@@ -0,0 +1,59 @@
+import secrets
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from directory_sync.models import ExternalDirectory
+from directory_sync.utils import get_syncer
+
+
+class Command(BaseCommand):
+    help = (
+        "Creates or renews the Microsoft Graph change-notification subscriptions (users, and groups "
+        "when groups are synced by groups delta) of every enabled Azure directory with a notification client state, "
+        "so new hires are synced within seconds instead of at the next poll. Subscriptions expire "
+        "after 28 days: run this daily (cron)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--url", default=None,
+            help="Public HTTPS URL of the notification endpoint (default: DIRECTORY_SYNC_NOTIFICATION_URL), "
+                 "e.g. https://portal.school.edu/directory-sync/graph/notifications/",
+        )
+        parser.add_argument(
+            "--directory", type=int, action="append", default=[],
+            help="Only this directory id (repeatable); generates its client state if it has none.",
+        )
+        parser.add_argument("--remove", action="store_true", help="Delete the subscriptions instead.")
+
+    def handle(self, *args, **opts):
+        qs = ExternalDirectory.objects.filter(provider="azure", is_enabled=True)
+        if opts["directory"]:
+            qs = qs.filter(pk__in=opts["directory"])
+        elif opts["remove"]:
+            qs = qs.exclude(graph_subscriptions=[])
+        else:
+            qs = qs.exclude(notification_client_state="")
+
+        url = opts["url"] or getattr(settings, "DIRECTORY_SYNC_NOTIFICATION_URL", "")
+        if not opts["remove"] and not url:
+            raise CommandError("No notification URL: pass --url or set DIRECTORY_SYNC_NOTIFICATION_URL.")
+
+        failed = 0
+        for d in qs:
+            try:
+                if opts["remove"]:
+                    n = get_syncer(d).unsubscribe()
+                    self.stdout.write(f"{d}: {n} subscriptions deleted")
+                    continue
+                if not d.notification_client_state:
+                    d.notification_client_state = secrets.token_urlsafe(32)
+                    d.save(update_fields=["notification_client_state"])
+                done = get_syncer(d).subscribe(url)
+                self.stdout.write(self.style.SUCCESS(
+                    f"{d}: " + (", ".join(f"{resource} {action}" for resource, action in done) or "nothing to do")
+                ))
+            except Exception as e:
+                failed += 1
+                self.stderr.write(f"{d}: {e.__class__.__name__}: {e}")
+        if failed:
+            raise CommandError(f"{failed} directories failed")
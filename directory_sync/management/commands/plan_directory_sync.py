@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from directory_sync.models import ExternalDirectory
+from directory_sync.utils import plan_summary, plan_sync, write_plan_csv
+
+
+class Command(BaseCommand):
+    help = (
+        "Dry run of the directory sync: lists the whole tenant, compares it with the local users "
+        "and writes what a sync would create, update and deactivate (one CSV row per changed "
+        "field) without changing anything. Same as the admin action, for directories too big "
+        "to list inside a web request."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("directory", type=int, nargs="+", help="Directory id(s).")
+        parser.add_argument(
+            "--output", "-o", default=None,
+            help="CSV file to write (default: directory-sync-plan-<timestamp>.csv in the current directory).",
+        )
+
+    def handle(self, *args, **opts):
+        directories = list(ExternalDirectory.objects.filter(pk__in=opts["directory"]).order_by("pk"))
+        unknown = set(opts["directory"]) - {d.pk for d in directories}
+        if unknown:
+            raise CommandError(f"No such directory: {', '.join(map(str, sorted(unknown)))}")
+
+        plans, failed = [], 0
+        for d in directories:
+            self.stdout.write(f"{d}: listing the directory...")
+            try:
+                plan = plan_sync(d)
+            except Exception as e:
+                failed += 1
+                self.stderr.write(f"{d}: dry run failed: {e.__class__.__name__}: {e}")
+                continue
+            self.stdout.write(plan_summary(d, plan))
+            plans.append((d, plan))
+
+        if plans:
+            path = opts["output"] or f"directory-sync-plan-{timezone.now():%Y%m%d-%H%M}.csv"
+            with open(path, "w", newline="", encoding="utf-8") as out:
+                write_plan_csv(out, plans)
+            rows = sum(len(plan["changes"]) for _, plan in plans)
+            self.stdout.write(self.style.SUCCESS(f"{rows} changes written to {path}"))
+        if failed:
+            raise CommandError(f"{failed} directories failed")
@@ -1,74 +1,42 @@
-import time, traceback
+import signal, sys
 from django.core.management.base import BaseCommand
-from django.utils import timezone
-# from django.db import transaction
-from datetime import timedelta
-from directory_sync.models import ExternalDirectory, SyncJob
-from directory_sync.utils import get_syncer, compute_next_run
-from django.db.models import Q
+from directory_sync.scheduler import Dispatcher, Leadership, no_in_process_scheduler, serve
 
 TICK_SECONDS = 30
-STALE_JOB_MINUTES = 30  # if a job 'runs' longer than this, consider it stale
 
 
 class Command(BaseCommand):
-    help = "Runs the directory sync scheduler (DB-driven)."
+    help = (
+        "Runs the directory sync scheduler (DB-driven). Due directories sync in parallel. "
+        "It stands for the same leader election as the in-process scheduler threads, so only one "
+        "process in the deployment dispatches and another takes over within about "
+        "DIRECTORY_SYNC_LEADER_TTL_SECONDS if it dies. Set DIRECTORY_SYNC_IN_PROCESS_SCHEDULER = False "
+        "to keep web workers out of it."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--max-concurrent", type=int, default=None,
+            help="How many directories may sync at once (default: DIRECTORY_SYNC_MAX_CONCURRENT, else 4; 1 on SQLite).",
+        )
+        parser.add_argument(
+            "--no-election", action="store_true",
+            help="Dispatch without being the leader, as an extra worker next to it. Runs are still "
+                 "claimed through directory leases, so no directory is synced twice at once.",
+        )
 
     def handle(self, *args, **opts):
-        self.stdout.write(self.style.SUCCESS("Directory scheduler started."))
-
-        # Boot-time cleanup: mark old 'running' jobs as failed so scheduler can proceed
-        cutoff = timezone.now() - timedelta(minutes=STALE_JOB_MINUTES)
-        stale = SyncJob.objects.filter(status="running", started_at__lt=cutoff)
-        for j in stale:
-            j.status = "failed"
-            j.finished_at = timezone.now()
-            j.notes = (j.notes or "") + f"\nAuto-failed as stale after restart (>{STALE_JOB_MINUTES}m)."
-            j.save(update_fields=["status", "finished_at", "notes"])
-
-        while True:
-            now = timezone.now()
-            due = ExternalDirectory.objects.filter(is_enabled=True).filter(
-                # run if next_run_at is null (first run) or due
-                Q(next_run_at__isnull=True) | Q(next_run_at__lte=now)
-            )
-            for d in due:
-                # Avoid overlapping runs; auto-fail stale ones
-                running = SyncJob.objects.filter(directory=d, status="running").first()
-                if running:
-                    cutoff = timezone.now() - timedelta(minutes=STALE_JOB_MINUTES)
-                    if running.started_at and running.started_at < cutoff:
-                        running.status = "failed"
-                        running.finished_at = timezone.now()
-                        running.notes = (running.notes or "") + f"\nAuto-failed as stale (>{STALE_JOB_MINUTES}m)."
-                        running.save(update_fields=["status", "finished_at", "notes"])
-                    else:
-                        continue
-
-                # Create job row first
-                job = SyncJob.objects.create(directory=d, status="running")
-
-                try:
-                    syncer = get_syncer(d)
-                    result = syncer.sync()
-                    job.mark(
-                        status="success",
-                        created=result.get("created", 0),
-                        updated=result.get("updated", 0),
-                        deactivated=result.get("deactivated", 0),
-                        notes=result.get("notes", ""),
-                    )
-                    d.last_run_at = timezone.now()
-                    d.last_status = "success"
-                    d.last_error = ""
-                except Exception as e:
-                    tb = traceback.format_exc()
-                    job.mark(status="failed", notes=str(e) + "\n" + tb)
-                    d.last_run_at = timezone.now()
-                    d.last_status = "failed"
-                    d.last_error = str(e)
-
-                d.next_run_at = compute_next_run(d, now=timezone.now())
-                d.save(update_fields=["last_run_at", "last_status", "last_error", "next_run_at"])
-
-            time.sleep(TICK_SECONDS)
+        no_in_process_scheduler()  # this process schedules through the loop below only
+        dispatcher = Dispatcher(max_workers=opts["max_concurrent"])
+        leadership = None if opts["no_election"] else Leadership()
+        role = "worker, no election" if leadership is None else "candidate for leader"
+        self.stdout.write(self.style.SUCCESS(f"Directory scheduler started ({dispatcher.owner}, {role})."))
+        # supervisors stop us with SIGTERM: leave through the finally below
+        signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+        try:
+            serve(dispatcher, TICK_SECONDS, leadership)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if leadership is not None:
+                leadership.resign()  # a standby takes over at its next heartbeat
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 16:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('directory_sync', '0005_alter_externaldirectory_delta_link'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='externaldirectory',
+            name='batch_requests',
+            field=models.BooleanField(default=True, help_text='Send the per-user manager/license/group lookups through Graph $batch (up to 20 per request) instead of one HTTP call each. Much faster on big tenants.'),
+        ),
+    ]
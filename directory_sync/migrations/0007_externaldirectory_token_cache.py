@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 16:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('directory_sync', '0006_externaldirectory_batch_requests'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='externaldirectory',
+            name='token_cache',
+            field=models.TextField(blank=True, editable=False, help_text='Serialized MSAL token cache (app-only Graph token). Managed automatically.'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 16:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('directory_sync', '0007_externaldirectory_token_cache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='externaldirectory',
+            name='enrichment_workers',
+            field=models.PositiveSmallIntegerField(default=4, help_text='How many manager/license/group lookups (or $batch calls) run in parallel. Database writes stay on one thread. 1 = sequential.'),
+        ),
+    ]
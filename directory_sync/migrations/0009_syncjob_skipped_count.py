@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 16:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('directory_sync', '0008_externaldirectory_enrichment_workers'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='syncjob',
+            name='skipped_count',
+            field=models.IntegerField(default=0, help_text='How many users were left untouched because their directory data had not changed.'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.4 on 2026-10-18 16:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('directory_sync', '0009_syncjob_skipped_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='externaldirectory',
+            name='group_sync_mode',
+            field=models.CharField(choices=[('per_user', 'Per user (getMemberGroups, transitive)'), ('delta', 'Groups delta crawl (direct members)')], default='per_user', help_text='How groups_cache is filled when groups are included. Per user: one getMemberGroups call per changed user (includes nested groups). Groups delta: one /groups/delta crawl per run, inverted onto users; an idle tenant costs a single call (direct memberships only).', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='externaldirectory',
+            name='groups_delta_link',
+            field=models.TextField(blank=True, help_text="Microsoft Graph /groups/delta cursor (Groups delta mode). Managed automatically; clearing forces a full rebuild of every user's groups."),
+        ),
+    ]
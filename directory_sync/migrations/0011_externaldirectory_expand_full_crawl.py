@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 16:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('directory_sync', '0010_externaldirectory_group_sync_mode'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='externaldirectory',
+            name='expand_full_crawl',
+            field=models.BooleanField(default=True, help_text='On a first or forced crawl (empty delta cursor), list /users with the manager expanded and assigned licenses inline instead of two extra calls per user, then continue with delta.'),
+        ),
+    ]
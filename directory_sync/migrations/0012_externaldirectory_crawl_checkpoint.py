@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 16:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('directory_sync', '0011_externaldirectory_expand_full_crawl'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='externaldirectory',
+            name='crawl_checkpoint',
+            field=models.JSONField(blank=True, default=dict, help_text='Where an unfinished crawl stopped (next page link and page number). Saved after each committed page so the next run continues there. Managed automatically; clear to start over.'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 16:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('directory_sync', '0012_externaldirectory_crawl_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='syncjob',
+            name='throttle_wait_seconds',
+            field=models.FloatField(default=0, help_text='Seconds this run spent waiting on Graph throttling (rate limiter, Retry-After, backoff), summed over worker threads.'),
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 5.2.4 on 2026-10-18 16:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('directory_sync', '0014_alter_externaldirectory_credentials'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='syncjob',
+            name='db_queries',
+            field=models.IntegerField(default=0, help_text='SQL statements issued by the sync thread.'),
+        ),
+        migrations.AddField(
+            model_name='syncjob',
+            name='db_seconds',
+            field=models.FloatField(default=0, help_text='Time spent in those SQL statements.'),
+        ),
+        migrations.AddField(
+            model_name='syncjob',
+            name='duration_seconds',
+            field=models.FloatField(blank=True, help_text='Wall time of the sync itself (token, Graph crawl, enrichment, DB writes).', null=True),
+        ),
+        migrations.AddField(
+            model_name='syncjob',
+            name='http_bytes',
+            field=models.BigIntegerField(default=0, help_text='Response bytes downloaded from the directory API.'),
+        ),
+        migrations.AddField(
+            model_name='syncjob',
+            name='http_calls',
+            field=models.IntegerField(default=0, help_text='HTTP calls made to the directory API (a $batch envelope counts as one). Per-endpoint counts are in metrics.'),
+        ),
+        migrations.AddField(
+            model_name='syncjob',
+            name='http_p50_ms',
+            field=models.FloatField(blank=True, help_text='Median HTTP call latency in milliseconds.', null=True),
+        ),
+        migrations.AddField(
+            model_name='syncjob',
+            name='http_p95_ms',
+            field=models.FloatField(blank=True, help_text='95th percentile HTTP call latency in milliseconds.', null=True),
+        ),
+        migrations.AddField(
+            model_name='syncjob',
+            name='metrics',
+            field=models.JSONField(blank=True, default=dict, help_text='Full telemetry of the run: the columns above plus HTTP calls by endpoint and wall time per phase (setup, fetch, prepare, enrich, write, groups). Filterable, e.g. metrics__phases__write__gt=10.'),
+        ),
+        migrations.AddField(
+            model_name='syncjob',
+            name='pages_fetched',
+            field=models.IntegerField(default=0, help_text='How many result pages were downloaded from the directory API.'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.4 on 2026-10-18 16:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('directory_sync', '0015_syncjob_metrics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='externaldirectory',
+            name='deprovision_max_percent',
+            field=models.PositiveSmallIntegerField(default=10, help_text="Safety limit for deprovisioning after a full crawl: if more than this percentage of the tenant's active synced users were not seen, nobody is deactivated and the job notes say why (guards against a truncated or mis-scoped crawl). 100 = no limit."),
+        ),
+        migrations.AlterField(
+            model_name='externaldirectory',
+            name='deprovision_missing',
+            field=models.BooleanField(default=False, help_text='When ON, users that disappear from the directory are deactivated locally (is_active=False). With delta sync, @removed entries also deactivate; after a full crawl, synced users of the tenant that were not seen in it are deactivated too.'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 17:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('directory_sync', '0016_externaldirectory_deprovision_max_percent'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='externaldirectory',
+            name='credentials',
+            field=models.JSONField(blank=True, default=dict, help_text='Connection JSON for the provider. For Azure: {"tenant_id": "...", "client_id": "...", "client_secret": "..." }. Optional: authority_host / graph_base (national clouds or a local stand-in) and ca_bundle. For Google: {"service_account": {...key file...}, "subject": "admin@school.edu", "customer": "my_customer"}; optional domain, api_base / token_uri and ca_bundle. Stored in the DB; rotate/regenerate secrets if they ever leak.'),
+        ),
+    ]
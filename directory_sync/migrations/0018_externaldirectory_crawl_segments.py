@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 17:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('directory_sync', '0017_alter_externaldirectory_credentials_google'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='externaldirectory',
+            name='crawl_segments',
+            field=models.PositiveSmallIntegerField(default=1, help_text='Split a first or forced crawl into this many userPrincipalName ranges, listed in parallel under the shared rate limit (expanded /users listing), then continue with delta. 1 = one serial crawl. Worth it for very large tenants (up to 26).'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.4 on 2026-10-18 17:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('directory_sync', '0018_externaldirectory_crawl_segments'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='externaldirectory',
+            name='graph_subscriptions',
+            field=models.JSONField(blank=True, default=list, help_text='Graph change-notification subscriptions of this tenant (id, resource, expiry). Managed by `manage.py graph_subscriptions`.'),
+        ),
+        migrations.AddField(
+            model_name='externaldirectory',
+            name='notification_client_state',
+            field=models.CharField(blank=True, help_text='Azure only: secret Graph echoes as clientState in user/group change notifications. When set, `manage.py graph_subscriptions` subscribes this tenant and every notification brings the next delta run forward (after a short debounce); polling stays as the fallback. Empty = polling only. The command generates one if needed.', max_length=128),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.4 on 2026-10-18 17:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('directory_sync', '0019_externaldirectory_change_notifications'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='externaldirectory',
+            name='lease_expires_at',
+            field=models.DateTimeField(blank=True, editable=False, help_text='End of the run lease; the owner renews it while the sync lasts. Once it has passed (the process died), any scheduler may take the directory over.', null=True),
+        ),
+        migrations.AddField(
+            model_name='externaldirectory',
+            name='lease_owner',
+            field=models.CharField(blank=True, editable=False, help_text='Scheduler process (host:pid:id) currently running this directory. Managed automatically.', max_length=200),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.4 on 2026-10-18 17:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('directory_sync', '0020_externaldirectory_lease'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SchedulerLeader',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(help_text='Which scheduler this row elects (one row each).', max_length=50, unique=True)),
+                ('owner', models.CharField(blank=True, help_text='Leading process (host:pid:id).', max_length=200)),
+                ('heartbeat_at', models.DateTimeField(blank=True, help_text='Last heartbeat of the leader.', null=True)),
+                ('expires_at', models.DateTimeField(blank=True, help_text='Leadership lapses at this time without a new heartbeat; a standby process then takes over.', null=True)),
+            ],
+            options={
+                'verbose_name': 'Scheduler leader',
+                'verbose_name_plural': 'Scheduler leader',
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+from django.db import migrations
+
+
+def reset_delta_links(apps, schema_editor):
+    # Cursors saved before manager@delta was tracked do not select "manager" (Graph keeps the
+    # $select inside the opaque token), so managers would never change again. The next run of
+    # every Azure directory does a full crawl and starts a cursor that includes it; an
+    # interrupted crawl's checkpoint holds such a cursor too (handoff_link) and goes as well.
+    ExternalDirectory = apps.get_model("directory_sync", "ExternalDirectory")
+    ExternalDirectory.objects.filter(provider="azure").exclude(delta_link="", crawl_checkpoint={}).update(
+        delta_link="", crawl_checkpoint={},
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("directory_sync", "0021_schedulerleader"),
+    ]
+
+    operations = [
+        migrations.RunPython(reset_delta_links, reverse_code=migrations.RunPython.noop),
+    ]
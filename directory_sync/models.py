@@ -59,6 +59,10 @@ class ExternalDirectory(models.Model):
         help_text=(
             "Connection JSON for the provider. For Azure: "
             '{"tenant_id": "...", "client_id": "...", "client_secret": "..." }. '
+            "Optional: authority_host / graph_base (national clouds or a local stand-in) and ca_bundle. "
+            "For Google: "
+            '{"service_account": {...key file...}, "subject": "admin@school.edu", "customer": "my_customer"}; '
+            "optional domain, api_base / token_uri and ca_bundle. "
             "Stored in the DB; rotate/regenerate secrets if they ever leak."
         )
     )
@@ -73,15 +77,67 @@ class ExternalDirectory(models.Model):
         default=True,
         help_text="Fetch and store group IDs on each user (groups_cache). Increases API calls/time."
     )
+    expand_full_crawl = models.BooleanField(
+        default=True,
+        help_text=(
+            "On a first or forced crawl (empty delta cursor), list /users with the manager expanded and "
+            "assigned licenses inline instead of two extra calls per user, then continue with delta."
+        )
+    )
+    crawl_segments = models.PositiveSmallIntegerField(
+        default=1,
+        help_text=(
+            "Split a first or forced crawl into this many userPrincipalName ranges, listed in parallel "
+            "under the shared rate limit (expanded /users listing), then continue with delta. "
+            "1 = one serial crawl. Worth it for very large tenants (up to 26)."
+        )
+    )
+    GROUP_SYNC_MODES = [
+        ("per_user", "Per user (getMemberGroups, transitive)"),
+        ("delta", "Groups delta crawl (direct members)"),
+    ]
+    group_sync_mode = models.CharField(
+        max_length=10,
+        choices=GROUP_SYNC_MODES,
+        default="per_user",
+        help_text=(
+            "How groups_cache is filled when groups are included. Per user: one getMemberGroups call "
+            "per changed user (includes nested groups). Groups delta: one /groups/delta crawl per run, "
+            "inverted onto users; an idle tenant costs a single call (direct memberships only)."
+        )
+    )
     include_licenses = models.BooleanField(
         default=True,
         help_text="Fetch license SKU codes per user (licenses). Increases API calls/time."
     )
+    batch_requests = models.BooleanField(
+        default=True,
+        help_text=(
+            "Send the per-user manager/license/group lookups through Graph $batch "
+            "(up to 20 per request) instead of one HTTP call each. Much faster on big tenants."
+        )
+    )
+    enrichment_workers = models.PositiveSmallIntegerField(
+        default=4,
+        help_text=(
+            "How many manager/license/group lookups (or $batch calls) run in parallel. "
+            "Database writes stay on one thread. 1 = sequential."
+        )
+    )
     deprovision_missing = models.BooleanField(
         default=False,
         help_text=(
             "When ON, users that disappear from the directory are deactivated locally "
-            "(is_active=False). With delta sync, @removed entries also deactivate."
+            "(is_active=False). With delta sync, @removed entries also deactivate; after a full "
+            "crawl, synced users of the tenant that were not seen in it are deactivated too."
+        )
+    )
+    deprovision_max_percent = models.PositiveSmallIntegerField(
+        default=10,
+        help_text=(
+            "Safety limit for deprovisioning after a full crawl: if more than this percentage of "
+            "the tenant's active synced users were not seen, nobody is deactivated and the job "
+            "notes say why (guards against a truncated or mis-scoped crawl). 100 = no limit."
         )
     )
     only_active = models.BooleanField(
@@ -92,6 +148,16 @@ class ExternalDirectory(models.Model):
             "Active users continue to sync normally."
         )
     )
+    notification_client_state = models.CharField(
+        max_length=128,
+        blank=True,
+        help_text=(
+            "Azure only: secret Graph echoes as clientState in user/group change notifications. "
+            "When set, `manage.py graph_subscriptions` subscribes this tenant and every notification "
+            "brings the next delta run forward (after a short debounce); polling stays as the fallback. "
+            "Empty = polling only. The command generates one if needed."
+        )
+    )
 
     # Status/progress (read-only in practice)
     last_run_at = models.DateTimeField(
@@ -119,6 +185,49 @@ class ExternalDirectory(models.Model):
             "Microsoft Graph delta cursor. Managed automatically; clearing forces a fresh delta crawl."
         )
     )
+    crawl_checkpoint = models.JSONField(
+        default=dict,
+        blank=True,
+        help_text=(
+            "Where an unfinished crawl stopped (next page link and page number). Saved after each "
+            "committed page so the next run continues there. Managed automatically; clear to start over."
+        )
+    )
+    groups_delta_link = models.TextField(
+        blank=True,
+        help_text=(
+            "Microsoft Graph /groups/delta cursor (Groups delta mode). Managed automatically; "
+            "clearing forces a full rebuild of every user's groups."
+        )
+    )
+    graph_subscriptions = models.JSONField(
+        default=list,
+        blank=True,
+        help_text=(
+            "Graph change-notification subscriptions of this tenant (id, resource, expiry). "
+            "Managed by `manage.py graph_subscriptions`."
+        )
+    )
+    token_cache = models.TextField(
+        blank=True,
+        editable=False,
+        help_text="Serialized MSAL token cache (app-only Graph token). Managed automatically."
+    )
+    lease_owner = models.CharField(
+        max_length=200,
+        blank=True,
+        editable=False,
+        help_text="Scheduler process (host:pid:id) currently running this directory. Managed automatically."
+    )
+    lease_expires_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        editable=False,
+        help_text=(
+            "End of the run lease; the owner renews it while the sync lasts. Once it has passed "
+            "(the process died), any scheduler may take the directory over."
+        )
+    )
 
     class Meta:
         verbose_name = "External directory"
@@ -163,12 +272,65 @@ class SyncJob(models.Model):
         default=0,
         help_text="How many users were set inactive (disabled or missing)."
     )
+    skipped_count = models.IntegerField(
+        default=0,
+        help_text="How many users were left untouched because their directory data had not changed."
+    )
+    throttle_wait_seconds = models.FloatField(
+        default=0,
+        help_text="Seconds this run spent waiting on Graph throttling (rate limiter, Retry-After, backoff), summed over worker threads."
+    )
     notes = models.TextField(
         blank=True,
         help_text="Free-form notes and sampled errors from the sync (for quick triage)."
     )
+    duration_seconds = models.FloatField(
+        null=True,
+        blank=True,
+        help_text="Wall time of the sync itself (token, Graph crawl, enrichment, DB writes)."
+    )
+    pages_fetched = models.IntegerField(
+        default=0,
+        help_text="How many result pages were downloaded from the directory API."
+    )
+    http_calls = models.IntegerField(
+        default=0,
+        help_text="HTTP calls made to the directory API (a $batch envelope counts as one). Per-endpoint counts are in metrics."
+    )
+    http_bytes = models.BigIntegerField(
+        default=0,
+        help_text="Response bytes downloaded from the directory API."
+    )
+    http_p50_ms = models.FloatField(
+        null=True,
+        blank=True,
+        help_text="Median HTTP call latency in milliseconds."
+    )
+    http_p95_ms = models.FloatField(
+        null=True,
+        blank=True,
+        help_text="95th percentile HTTP call latency in milliseconds."
+    )
+    db_queries = models.IntegerField(
+        default=0,
+        help_text="SQL statements issued by the sync thread."
+    )
+    db_seconds = models.FloatField(
+        default=0,
+        help_text="Time spent in those SQL statements."
+    )
+    metrics = models.JSONField(
+        default=dict,
+        blank=True,
+        help_text=(
+            "Full telemetry of the run: the columns above plus HTTP calls by endpoint and wall time "
+            "per phase (setup, fetch, prepare, enrich, write, groups). Filterable, e.g. "
+            "metrics__phases__write__gt=10."
+        ),
+    )
 
-    def mark(self, *, status=None, created=None, updated=None, deactivated=None, notes=None):
+    def mark(self, *, status=None, created=None, updated=None, deactivated=None, skipped=None,
+             throttle_wait=None, metrics=None, notes=None):
         if status:
             self.status = status
         if created is not None:
@@ -177,6 +339,20 @@ class SyncJob(models.Model):
             self.updated_count = updated
         if deactivated is not None:
             self.deactivated_count = deactivated
+        if skipped is not None:
+            self.skipped_count = skipped
+        if throttle_wait is not None:
+            self.throttle_wait_seconds = throttle_wait
+        if metrics:
+            self.metrics = metrics
+            self.duration_seconds = metrics.get("wall_seconds")
+            self.pages_fetched = metrics.get("pages", 0)
+            self.http_calls = metrics.get("http_calls", 0)
+            self.http_bytes = metrics.get("http_bytes", 0)
+            self.http_p50_ms = metrics.get("http_p50_ms")
+            self.http_p95_ms = metrics.get("http_p95_ms")
+            self.db_queries = metrics.get("db_queries", 0)
+            self.db_seconds = metrics.get("db_seconds", 0)
         if notes:
             self.notes = (self.notes or "") + ("\n" if self.notes else "") + notes
         if status in {"success", "failed"} and not self.finished_at:
@@ -191,3 +367,26 @@ class SyncJob(models.Model):
         # helpful in the admin list
         ts = self.started_at.strftime("%Y-%m-%d %H:%M") if self.started_at else "—"
         return f"{self.directory.name} — {self.status} @ {ts}"
+
+
+class SchedulerLeader(models.Model):
+    """
+    Heartbeat row of the scheduler leader election: of all processes that run a scheduler
+    loop, only the one named in `owner` dispatches, renewing `expires_at` on every
+    heartbeat. When it stops, another process takes over once `expires_at` has passed.
+    """
+    name = models.CharField(max_length=50, unique=True, help_text="Which scheduler this row elects (one row each).")
+    owner = models.CharField(max_length=200, blank=True, help_text="Leading process (host:pid:id).")
+    heartbeat_at = models.DateTimeField(null=True, blank=True, help_text="Last heartbeat of the leader.")
+    expires_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text="Leadership lapses at this time without a new heartbeat; a standby process then takes over."
+    )
+
+    class Meta:
+        verbose_name = "Scheduler leader"
+        verbose_name_plural = "Scheduler leader"
+
+    def __str__(self):
+        return f"{self.name}: {self.owner or '—'}"
@@ -1,21 +1,35 @@
-import os, threading, time, traceback
+import atexit, logging, os, socket, threading, time, traceback, uuid, weakref
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from django.conf import settings
+from django.db import close_old_connections, connection
 from django.utils import timezone
-from django.db.models import Q
-from .models import ExternalDirectory, SyncJob
+from django.db.models import F, Min, Q
+from .models import ExternalDirectory, SchedulerLeader, SyncJob
 from .utils import get_syncer, compute_next_run
 
+logger = logging.getLogger(__name__)
+
 _started_flag = False
+_dispatchers = weakref.WeakSet()  # scheduler loops of this process, woken by request_run()
+_owner = (None, "")  # (pid, lease owner id) of this process
 
 def _now_local():
     # Convert UTC “now” to the default time zone (Asia/Baghdad from settings)
     return timezone.localtime(timezone.now())
 
 def start_scheduler_once():
-    """Start exactly once (avoid duplicate threads with the autoreloader)."""
+    """
+    Start exactly once (avoid duplicate threads with the autoreloader). Every process that
+    starts it stands for election; only the leader dispatches (see Leadership).
+    DIRECTORY_SYNC_IN_PROCESS_SCHEDULER = False keeps this process (e.g. web workers) out
+    entirely; run `manage.py run_directory_scheduler` somewhere instead.
+    """
     global _started_flag
     if _started_flag:
         return
+    if not getattr(settings, "DIRECTORY_SYNC_IN_PROCESS_SCHEDULER", True):
+        return
     # Guard for the dev autoreloader
     if settings.DEBUG and os.environ.get("RUN_MAIN") != "true":
         return
@@ -25,35 +39,321 @@ def start_scheduler_once():
     t = threading.Thread(target=_loop, args=(tick,), daemon=True, name="directory-sync-scheduler")
     t.start()
 
-def _loop(tick_seconds: int):
-    while True:
-        now = _now_local()
-        due = ExternalDirectory.objects.filter(is_enabled=True).filter(
-            Q(next_run_at__isnull=True) | Q(next_run_at__lte=now)
+def no_in_process_scheduler():
+    """For processes that run their own loop (the scheduler command): never start the thread here."""
+    global _started_flag
+    _started_flag = True
+
+def due_directories(now):
+    """
+    Enabled directories whose next run is due (or never planned) and that nobody holds a
+    live lease on, longest overdue first.
+    """
+    return ExternalDirectory.objects.filter(is_enabled=True).filter(
+        Q(next_run_at__isnull=True) | Q(next_run_at__lte=now)
+    ).filter(
+        Q(lease_expires_at__isnull=True) | Q(lease_expires_at__lte=now)
+    ).order_by(F("next_run_at").asc(nulls_first=True), "pk")
+
+# --- run leases: several scheduler processes share the directories without running one twice ---
+def lease_owner():
+    """This process's lease owner id (host:pid:random); a forked worker gets its own."""
+    global _owner
+    if _owner[0] != os.getpid():
+        _owner = (os.getpid(), f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}")
+    return _owner[1]
+
+def _lease_seconds():
+    return getattr(settings, "DIRECTORY_SYNC_LEASE_SECONDS", 300)
+
+def _max_run_seconds():
+    return getattr(settings, "DIRECTORY_SYNC_MAX_RUN_SECONDS", 6 * 3600)
+
+def _max_concurrent():
+    # SQLite takes one writer at a time: parallel runs would only queue behind each other's
+    # page transactions (and fail with "database is locked" once the busy timeout runs out)
+    return getattr(settings, "DIRECTORY_SYNC_MAX_CONCURRENT", 1 if connection.vendor == "sqlite" else 4)
+
+def claim(d, owner):
+    """
+    Takes the run lease of d with one conditional UPDATE: it only matches while the directory
+    is still enabled and due and nobody holds an unexpired lease, so of several processes
+    claiming at once exactly one succeeds, and a due list read before another process's run
+    finished cannot start it again. On success d is reloaded (the cursor and checkpoint that
+    run left behind). Returns whether `owner` holds the lease now.
+    """
+    now = timezone.now()
+    claimed = ExternalDirectory.objects.filter(pk=d.pk, is_enabled=True).filter(
+        Q(next_run_at__isnull=True) | Q(next_run_at__lte=now)
+    ).filter(
+        Q(lease_expires_at__isnull=True) | Q(lease_expires_at__lte=now)
+    ).update(lease_owner=owner, lease_expires_at=now + timedelta(seconds=_lease_seconds()))
+    if claimed:
+        d.refresh_from_db()
+    return bool(claimed)
+
+def renew(pks, owner):
+    """Extends the leases `owner` still holds on these directories; returns how many it holds."""
+    if not pks:
+        return 0
+    return ExternalDirectory.objects.filter(pk__in=pks, lease_owner=owner).update(
+        lease_expires_at=timezone.now() + timedelta(seconds=_lease_seconds()),
+    )
+
+def release(d, owner):
+    """Gives the lease back (only if `owner` still holds it), so the directory is free at once."""
+    ExternalDirectory.objects.filter(pk=d.pk, lease_owner=owner).update(lease_owner="", lease_expires_at=None)
+
+def fail_orphaned_jobs(d):
+    """
+    Marks running jobs of d as failed. Only called by the lease holder: any job still
+    "running" then belongs to a process that lost its lease (crashed or was killed).
+    """
+    for job in SyncJob.objects.filter(directory=d, status="running"):
+        job.mark(status="failed", notes="Auto-failed: its scheduler process lost the run lease (crashed or stopped).")
+
+def seconds_until_next_run(limit):
+    """
+    How long the scheduler loop may sleep: until the earliest planned run of an enabled
+    directory, at most `limit`. Overdue directories are waiting for a slot or for their
+    own run to finish, which wakes the loop anyway.
+    """
+    nxt = ExternalDirectory.objects.filter(is_enabled=True).aggregate(m=Min("next_run_at"))["m"]
+    if nxt is None:
+        return limit
+    remaining = (nxt - timezone.now()).total_seconds()
+    return limit if remaining <= 0 else min(limit, remaining)
+
+def request_run(directory_pk, debounce_seconds=None):
+    """
+    Brings a directory's next run forward to now + debounce (DIRECTORY_SYNC_NOTIFY_DEBOUNCE_SECONDS,
+    default 20), e.g. for a Graph change notification. A burst coalesces into one run: later calls
+    find it planned earlier already and change nothing. Returns whether next_run_at moved.
+    """
+    if debounce_seconds is None:
+        debounce_seconds = getattr(settings, "DIRECTORY_SYNC_NOTIFY_DEBOUNCE_SECONDS", 20)
+    at = timezone.now() + timedelta(seconds=debounce_seconds)
+    # a null next_run_at is due already
+    moved = ExternalDirectory.objects.filter(pk=directory_pk, is_enabled=True, next_run_at__gt=at).update(next_run_at=at)
+    if moved:
+        for dispatcher in list(_dispatchers):
+            dispatcher.wake.set()  # re-plans its sleep around the new time
+    return bool(moved)
+
+
+def run_directory(d):
+    """
+    One sync of one directory: its SyncJob row, the sync itself, the outcome on the
+    directory and its next_run_at, computed from when this run finished.
+    """
+    job = SyncJob.objects.create(directory=d, status="running")
+    # planned while the run is in flight, so a change notification arriving meanwhile can
+    # still move it forward (request_run) instead of being absorbed by this run
+    planned = compute_next_run(d, now=_now_local())
+    ExternalDirectory.objects.filter(pk=d.pk).update(next_run_at=planned)
+    try:
+        syncer = get_syncer(d)
+        result = syncer.sync()  # dict(created=.., updated=.., deactivated=.., notes="..")
+        job.mark(
+            status="success",
+            created=result.get("created", 0),
+            updated=result.get("updated", 0),
+            deactivated=result.get("deactivated", 0),
+            skipped=result.get("skipped", 0),
+            throttle_wait=result.get("throttle_wait", 0),
+            metrics=result.get("metrics"),
+            notes=result.get("notes", ""),
         )
-        for d in due:
-            # Skip if a job for this directory is already running
-            if SyncJob.objects.filter(directory=d, status="running").exists():
-                continue
+        d.last_status, d.last_error = "success", ""
+    except Exception as e:
+        job.mark(status="failed", notes=f"{e}\n{traceback.format_exc()}")
+        d.last_status, d.last_error = "failed", str(e)
 
-            job = SyncJob.objects.create(directory=d, status="running")
+    d.last_run_at = _now_local()
+    d.next_run_at = compute_next_run(d, now=_now_local())
+    # a notification (or "Run sync now") during the run asked for another one soon
+    requested = ExternalDirectory.objects.filter(pk=d.pk).values_list("next_run_at", flat=True).first()
+    if requested and requested < planned:
+        d.next_run_at = min(requested, d.next_run_at)
+    d.save(update_fields=["last_run_at", "last_status", "last_error", "next_run_at"])
+    return job
+
+
+class Dispatcher:
+    """
+    Runs due directories on a bounded thread pool, so one slow tenant no longer delays
+    everybody else's schedule. At most DIRECTORY_SYNC_MAX_CONCURRENT (default 4; 1 on SQLite,
+    which has a single writer) runs are in flight in this process; a directory is never
+    dispatched while its own run is.
+    `wake` is set whenever a run finishes, so the loop can fill the free slot right away,
+    and by request_run() when a directory's next run moves forward.
+
+    A run starts only after claim() got the directory's lease, so any number of processes
+    can dispatch side by side. A renewal thread extends the leases of the runs in flight
+    every third of DIRECTORY_SYNC_LEASE_SECONDS (default 300); a process that dies stops
+    renewing and its directories become claimable once the lease runs out. A run still going
+    after DIRECTORY_SYNC_MAX_RUN_SECONDS (default 6 hours) is taken for hung: its lease is no
+    longer renewed, so another process can claim the directory (failing the stuck job) while
+    the stuck thread keeps its slot here until it returns.
+    """
+
+    def __init__(self, max_workers=None, owner=None):
+        self.max_workers = max(1, max_workers or _max_concurrent())
+        self.owner = owner or lease_owner()
+        self.pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="directory-sync-run")
+        self.in_flight = {}  # directory pk -> time.monotonic() when its run started
+        self.wake = threading.Event()
+        self._lock = threading.Lock()
+        _dispatchers.add(self)
+        threading.Thread(target=self._renew_loop, daemon=True, name="directory-sync-lease").start()
+
+    def has_capacity(self):
+        with self._lock:
+            return len(self.in_flight) < self.max_workers
+
+    def is_running(self, d):
+        with self._lock:
+            return d.pk in self.in_flight
+
+    def dispatch(self, d):
+        """
+        Starts a run of d if a slot is free, d is not running here yet and its lease could be
+        claimed (no other process runs it); returns whether it did.
+        """
+        with self._lock:
+            if d.pk in self.in_flight or len(self.in_flight) >= self.max_workers:
+                return False
+            self.in_flight[d.pk] = time.monotonic()
+        try:
+            claimed = claim(d, self.owner)
+        except Exception:
+            claimed = False
+            logger.exception("directory sync: could not claim the run lease of %s", d)
+        if not claimed:
+            with self._lock:
+                self.in_flight.pop(d.pk, None)
+            return False
+        self.pool.submit(self._run, d)
+        return True
+
+    def _run(self, d):
+        close_old_connections()
+        try:
+            fail_orphaned_jobs(d)
+            run_directory(d)
+        except Exception:
+            # bookkeeping failed (e.g. DB down); the directory stays due
+            logger.exception("directory sync: run of %s failed outside the sync", d)
+        finally:
             try:
-                syncer = get_syncer(d)
-                result = syncer.sync()  # dict(created=.., updated=.., deactivated=.., notes="..")
-                job.mark(
-                    status="success",
-                    created=result.get("created", 0),
-                    updated=result.get("updated", 0),
-                    deactivated=result.get("deactivated", 0),
-                    notes=result.get("notes", ""),
+                release(d, self.owner)
+            except Exception:
+                logger.exception("directory sync: could not release the lease of %s; it runs out instead", d)
+            close_old_connections()
+            with self._lock:
+                self.in_flight.pop(d.pk, None)
+            self.wake.set()
+
+    def _renew_loop(self):
+        overdue_seen = set()  # stuck runs already reported
+        while True:
+            time.sleep(max(1, _lease_seconds() / 3))
+            now = time.monotonic()
+            with self._lock:
+                running = dict(self.in_flight)
+            pks = [pk for pk, started in running.items() if now - started < _max_run_seconds()]
+            overdue = set(running) - set(pks)
+            if overdue - overdue_seen:
+                logger.error(
+                    "directory sync: run(s) of directory %s exceeded DIRECTORY_SYNC_MAX_RUN_SECONDS; "
+                    "their leases are no longer renewed", sorted(overdue - overdue_seen),
                 )
-                d.last_status, d.last_error = "success", ""
-            except Exception as e:
-                job.mark(status="failed", notes=f"{e}\n{traceback.format_exc()}")
-                d.last_status, d.last_error = "failed", str(e)
+            overdue_seen = overdue
+            if not pks:
+                continue
+            try:
+                held = renew(pks, self.owner)
+                if held < len(pks):
+                    logger.warning("directory sync: %d run lease(s) of %s were lost", len(pks) - held, self.owner)
+            except Exception:
+                # DB hiccup: try again next round, before the lease runs out
+                logger.exception("directory sync: renewing the run leases of %s failed", self.owner)
+            finally:
+                close_old_connections()
+
+class Leadership:
+    """
+    Leader election on a SchedulerLeader heartbeat row, so one process in the deployment
+    schedules however many web workers and scheduler commands are running.
+
+    heartbeat() takes or keeps the leadership with one conditional UPDATE (only matches
+    when this process leads already or the leader's expires_at has passed) and pushes
+    expires_at DIRECTORY_SYNC_LEADER_TTL_SECONDS (default 60) ahead. The loop calls it at
+    least every `interval` (a third of the TTL), so a leader that dies is replaced within
+    TTL + interval of its last heartbeat. A leader that misses its heartbeats (e.g. the
+    database was unreachable) stops dispatching; runs already started finish under their
+    own leases.
+    """
+
+    def __init__(self, name="directory-sync", owner=None):
+        self.name = name
+        # one process may run two loops (thread + command); each is its own candidate
+        self.owner = owner or f"{lease_owner()}:{uuid.uuid4().hex[:4]}"
+        self.ttl = getattr(settings, "DIRECTORY_SYNC_LEADER_TTL_SECONDS", 60)
+        self.interval = max(1, self.ttl / 3)
+        self.is_leader = False
+
+    def heartbeat(self):
+        """Returns whether this process leads now."""
+        now = timezone.now()
+        SchedulerLeader.objects.get_or_create(name=self.name)
+        won = SchedulerLeader.objects.filter(name=self.name).filter(
+            Q(owner=self.owner) | Q(expires_at__isnull=True) | Q(expires_at__lte=now)
+        ).update(owner=self.owner, heartbeat_at=now, expires_at=now + timedelta(seconds=self.ttl))
+        if bool(won) != self.is_leader:
+            log = logger.info if won else logger.warning
+            log("directory sync: %s %s the scheduler leader", self.owner, "is now" if won else "is no longer")
+        self.is_leader = bool(won)
+        return self.is_leader
+
+    def resign(self):
+        """Hands leadership over right away (clean shutdown) instead of after the TTL."""
+        SchedulerLeader.objects.filter(name=self.name, owner=self.owner).update(owner="", expires_at=None)
+        self.is_leader = False
+
+def serve(dispatcher, tick_seconds, leadership=None):
+    """
+    The scheduler loop. Dispatches due directories (each claimed through its lease) and
+    sleeps until the next run is due, at most tick_seconds. With `leadership`, only while
+    this process is the leader; standbys heartbeat every leadership.interval to take over.
+    """
+    while True:
+        dispatcher.wake.clear()
+        wait = tick_seconds
+        try:
+            if leadership is None or leadership.heartbeat():
+                for d in due_directories(timezone.now()):
+                    if not dispatcher.has_capacity():
+                        break
+                    # claims the lease; a directory running here or in another process is skipped
+                    dispatcher.dispatch(d)
+                wait = seconds_until_next_run(tick_seconds)
+            if leadership is not None:
+                wait = min(wait, leadership.interval)
+        except Exception:
+            logger.exception("directory sync: scheduler tick failed, trying again")  # DB unreachable etc.
+        finally:
+            close_old_connections()
+        dispatcher.wake.wait(wait)
+
+def _loop(tick_seconds: int):
+    leadership = Leadership()
 
-            d.last_run_at = _now_local()
-            d.next_run_at = compute_next_run(d, now=_now_local())
-            d.save(update_fields=["last_run_at", "last_status", "last_error", "next_run_at"])
+    def resign():
+        try:
+            leadership.resign()
+        except Exception:
+            pass  # the database may be gone at exit; the TTL hands over then
 
-        time.sleep(tick_seconds)
+    atexit.register(resign)
+    serve(Dispatcher(), tick_seconds, leadership)
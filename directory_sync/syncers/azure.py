@@ -1,106 +1,753 @@
-import os, time, requests
-from msal import ConfidentialClientApplication
+import hashlib, json, os, requests
+from urllib.parse import urlencode
+from collections import Counter, defaultdict
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from django.db import transaction
 from accounts.models import User
+from .base import BaseSyncer
+from .jsonstream import iter_object
+from .pipeline import merge, prefetch
+from .ratelimit import THROTTLE_STATUSES, backoff_seconds
+from .writer import SYNCED_FIELDS, PageWriter, deactivate, field_changes_note, unseen_users
 
-GRAPH_SCOPE = ["https://graph.microsoft.com/.default"]
 GRAPH_BASE = "https://graph.microsoft.com/v1.0"
+BATCH_MAX = 20  # Graph's hard limit of sub-requests per $batch envelope
+USER_SELECT = "id,mail,userPrincipalName,givenName,surname,displayName,jobTitle,department,accountEnabled"
+# users/delta also tracks the manager relationship: "manager@delta" carries the manager's id
+# on the initial round and again whenever it changes
+DELTA_SELECT = USER_SELECT + ",manager"
+EXPAND_PAGE_SIZE = 100  # Graph pages that expand a navigation property are capped well below 999
+SEGMENT_LETTERS = "abcdefghijklmnopqrstuvwxyz"  # crawl_segments split userPrincipalName at these
+SUBSCRIPTION_MINUTES = 40320  # 28 days; Graph allows a little under 29 for users and groups
+# all users and groups accept; a new user or group is notified as "updated"
+SUBSCRIPTION_CHANGE_TYPES = "updated,deleted"
+STREAM_CHUNK_USERS = 200  # users per piece when pages are streamed (DIRECTORY_SYNC_STREAM_PAGES)
+# what a dry run compares: everything that comes with the user itself, no per-user lookups
+PLAN_FIELDS = [f for f in SYNCED_FIELDS if f not in ("manager_email", "licenses", "groups_cache", "directory_fingerprint")]
 
 
-class AzureSyncer:
+def _mail(user):
+    return (user.get("mail") or user.get("userPrincipalName") or "").strip().lower() or None
+
+
+class ManagerCache:
+    """
+    Manager azure_oid -> email for one run. Every user the crawl lists is remembered, so
+    most managers are known before anybody points at them; lookups that miss go to
+    local users and then to Graph, and the answer (also "no such user") is kept.
+    Counts per lookup where it was answered, for the job telemetry.
+    """
+
+    def __init__(self):
+        self.emails = {}
+        self.lookups = 0
+        self.answered = Counter()  # "run" (already known) / "local" / "graph"
+
+    def learn(self, oid, email):
+        if oid and email:
+            self.emails[oid] = email
+
+    def unknown(self, oids):
+        return list(dict.fromkeys(oid for oid in oids if oid not in self.emails))
+
+    def add(self, found):
+        self.emails.update(found)
+
+    def get(self, oid, source):
+        """Email for a looked-up manager, counting the lookup under `source`."""
+        self.lookups += 1
+        self.answered[source] += 1
+        return self.emails.get(oid)
+
+    def stats(self):
+        hits = self.answered["run"] + self.answered["local"]
+        return {
+            "lookups": self.lookups,
+            "run_hits": self.answered["run"],
+            "local_hits": self.answered["local"],
+            "graph_lookups": self.answered["graph"],
+            "hit_rate": round(hits / self.lookups, 3) if self.lookups else None,
+        }
+
+
+class AzureSyncer(BaseSyncer):
+    provider = "azure"
+    identity_source = "AZURE"
+    oid_field = "azure_oid"
+    plan_fields = PLAN_FIELDS
+    plan_note = "manager, licenses and groups are not compared in a dry run"
+
     def __init__(self, directory):
-        self.d = directory
         c = directory.credentials or {}
         self.tenant_id = c.get("tenant_id")
         self.client_id = c.get("client_id")
         self.client_secret = c.get("client_secret")
+        self.graph_base = (c.get("graph_base") or GRAPH_BASE).rstrip("/")
+        self.expanded = False  # True while a full crawl gets manager/licenses inline
+        self.checkpoint_rejected = False  # set by _resumed_pages, on a fetch thread
+        super().__init__(directory, ("azure", self.tenant_id))
 
-    def _token(self):
-        app = ConfidentialClientApplication(
-            client_id=self.client_id,
-            client_credential=self.client_secret,
-            authority=f"https://login.microsoftonline.com/{self.tenant_id}",
-        )
-        result = app.acquire_token_for_client(scopes=GRAPH_SCOPE)
-        if "access_token" not in result:
-            raise RuntimeError(f"Azure token error: {result}")
-        return result["access_token"]
-
-    def _get(self, url, token, params=None, retry=1):
-        r = requests.get(url, headers={"Authorization": f"Bearer {token}"}, params=params or {})
-        if r.status_code == 429 and retry <= 3:
-            time.sleep(int(r.headers.get("Retry-After", "2")))
-            return self._get(url, token, params, retry + 1)
+    def _get(self, url, params=None):
+        r = self._request("GET", url, params=params or {})
         r.raise_for_status()
         return r.json()
 
-    def test_connection(self):
-        token = self._token()
-        # simple call
-        _ = self._get(f"{GRAPH_BASE}/organization", token)
-        return True
+    def _post(self, url, json=None, repeatable=False):
+        r = self._request("POST", url, json=json, repeatable=repeatable)
+        r.raise_for_status()
+        return r.json()
+
+    def _streamed_page(self, url, params=None):
+        """
+        One Graph page decoded while it downloads, handed out as pieces of at most
+        STREAM_CHUNK_USERS users; only the last piece carries the page's
+        @odata.nextLink / @odata.deltaLink. Memory stays at one piece, whatever $top is.
+
+        Graph sends the links *before* "value", so every member but "value" is held back
+        until the page is complete: a link must not reach the caller (which checkpoints
+        on it) while part of its page is still unread.
+        """
+        r = self._request("GET", url, params=params or {}, stream=True)
+        try:
+            r.raise_for_status()
+
+            def chunks():
+                for chunk in r.iter_content(chunk_size=65536):
+                    self.http.stats.add_bytes(len(chunk))
+                    yield chunk
+
+            members = {}  # @odata.* and anything else, whatever their position in the body
+            piece = []
+            for key, value in iter_object(chunks()):
+                if key != "value":
+                    members[key] = value
+                    continue
+                piece.append(value)
+                if len(piece) >= STREAM_CHUNK_USERS:
+                    yield {"value": piece}
+                    piece = []
+            yield dict(members, value=piece)
+        finally:
+            r.close()
+
+    def _pages(self, url, params=None):
+        """
+        Graph pages starting at url, following @odata.nextLink; the last one carries the deltaLink.
+        With DIRECTORY_SYNC_STREAM_PAGES (default on) each page arrives as several smaller
+        pieces (see _streamed_page), which callers handle exactly like pages.
+        """
+        stream = getattr(settings, "DIRECTORY_SYNC_STREAM_PAGES", True)
+        while True:
+            pieces = self._streamed_page(url, params) if stream else [self._get(url, params=params)]
+            for data in pieces:
+                yield data
+            if self.metrics:
+                self.metrics.pages += 1
+            next_url = data.get("@odata.nextLink")
+            if not next_url:
+                return
+            url, params = next_url, None
+
+    def _resumed_pages(self, url):
+        """
+        _pages from a saved checkpoint. A nextLink Graph no longer accepts sets
+        checkpoint_rejected; this runs on a fetch thread, so _dropping_rejected_checkpoint
+        clears the checkpoint on the sync thread.
+        """
+        pages = self._pages(url)
+        try:
+            first = next(pages)
+        except requests.HTTPError as e:
+            status = e.response.status_code if e.response is not None else 0
+            if 400 <= status < 500 and status != 429:
+                self.checkpoint_rejected = True
+            raise
+        yield first
+        yield from pages
+
+    def _dropping_rejected_checkpoint(self, stream):
+        """Iterates stream; when a resumed listing failed on its checkpoint, the next run starts the crawl over."""
+        try:
+            yield from stream
+        except requests.HTTPError:
+            if self.checkpoint_rejected:
+                self._save_checkpoint({})
+            raise
+
+    def _save_checkpoint(self, checkpoint):
+        self.d.crawl_checkpoint = checkpoint
+        self.d.save(update_fields=["crawl_checkpoint"])
+
+    def _per_user_groups(self):
+        return self.d.include_groups and getattr(self.d, "group_sync_mode", "per_user") != "delta"
+
+    # --- per-user extras (licenses / groups) ---
+    def _extra_requests(self, uid):
+        """Sub-requests for one user, as (kind, method, relative url, body)."""
+        reqs = []
+        if self.d.include_licenses and not self.expanded:
+            reqs.append(("licenses", "GET", f"/users/{uid}/licenseDetails", None))
+        if self._per_user_groups():
+            reqs.append(("groups", "POST", f"/users/{uid}/getMemberGroups", {"securityEnabledOnly": False}))
+        return reqs
+
+    @staticmethod
+    def _lookup_failed(extras, kind, uid, status):
+        """Records a lookup that still failed after all retries under extras["failed"][kind]."""
+        extras.setdefault("failed", {})[kind] = requests.HTTPError(f"{status} Error for {kind} of user {uid}")
 
-    def sync(self):
-        token = self._token()
+    def _enrich_user(self, uid):
+        """
+        One HTTP call per extra. Returns a dict with "licenses" / "groups_cache" when
+        fetched successfully (only the groups during an expanded crawl), and
+        "failed": {kind: HTTPError} for the lookups that were not.
+        """
+        extras = {}
+        if self.d.include_licenses and not self.expanded:
+            r = self._request("GET", f"{self.graph_base}/users/{uid}/licenseDetails")
+            if r.status_code == 200:
+                lic = r.json()
+                extras["licenses"] = [x.get("skuPartNumber") for x in lic.get("value", []) if x.get("skuPartNumber")]
+            else:
+                self._lookup_failed(extras, "licenses", uid, r.status_code)
 
-        # Start from saved delta_link if present, else do an initial delta crawl
-        base_select = "id,mail,userPrincipalName,givenName,surname,displayName,jobTitle,department,accountEnabled"
-        if self.d.delta_link:
-            url = self.d.delta_link
-            params = None  # deltaLink already encodes params
+        if self._per_user_groups():
+            r = self._request(
+                "POST",
+                f"{self.graph_base}/users/{uid}/getMemberGroups",
+                json={"securityEnabledOnly": False},
+                repeatable=True,
+            )
+            if r.status_code == 200:
+                extras["groups_cache"] = r.json().get("value", [])
+            else:
+                self._lookup_failed(extras, "groups", uid, r.status_code)
+        return extras
+
+    def _batch(self, items):
+        """
+        Sends {id: $batch sub-request} in envelopes of BATCH_MAX and returns {id: response}.
+        Throttled items (429/503/504) are fed to the rate limiter and retried in the next
+        envelope, like _request does for single calls.
+        """
+        pending = dict(items)
+        responses = {}
+        attempt = 1
+        max_attempts = getattr(settings, "DIRECTORY_SYNC_GRAPH_MAX_ATTEMPTS", 6)
+        while pending:
+            throttled = {}
+            keys = list(pending)
+            for i in range(0, len(keys), BATCH_MAX):
+                chunk = [pending[k] for k in keys[i:i + BATCH_MAX]]
+                data = self._post(f"{self.graph_base}/$batch", json={"requests": chunk}, repeatable=True)
+                for resp in data.get("responses", []):
+                    rid = resp.get("id")
+                    if rid not in pending:
+                        continue
+                    if resp.get("status") in THROTTLE_STATUSES and attempt < max_attempts:
+                        throttled[rid] = pending[rid]
+                        headers = {k.lower(): v for k, v in (resp.get("headers") or {}).items()}
+                        self.limiter.throttled(backoff_seconds(headers.get("retry-after"), attempt))
+                    else:
+                        responses[rid] = resp
+            pending = throttled
+            attempt += 1
+        return responses
+
+    def _enrich_batch(self, uids):
+        """Same lookups as _enrich_user, packed into $batch envelopes. Returns {uid: extras dict}."""
+        items, owners = {}, {}
+        for uid in uids:
+            for kind, method, rel_url, body in self._extra_requests(uid):
+                item = {"id": str(len(items)), "method": method, "url": rel_url}
+                if body is not None:
+                    item["body"] = body
+                    item["headers"] = {"Content-Type": "application/json"}
+                items[item["id"]] = item
+                owners[item["id"]] = (uid, kind)
+
+        results = {uid: {} for uid in uids}
+        for rid, resp in self._batch(items).items():
+            uid, kind = owners[rid]
+            status = resp.get("status")
+            body = resp.get("body") or {}
+            extras = results[uid]
+            if status != 200:
+                self._lookup_failed(extras, kind, uid, status)
+            elif kind == "licenses":
+                extras["licenses"] = [x.get("skuPartNumber") for x in body.get("value", []) if x.get("skuPartNumber")]
+            elif kind == "groups":
+                extras["groups_cache"] = body.get("value", [])
+        return results
+
+    # --- managers ---
+    def _manager_emails(self, oids):
+        """{manager oid: email or None} straight from Graph (network only, runs on the worker pool)."""
+        found = {}
+        if getattr(self.d, "batch_requests", False):
+            items = {
+                str(i): {"id": str(i), "method": "GET", "url": f"/users/{oid}?$select=mail,userPrincipalName"}
+                for i, oid in enumerate(oids)
+            }
+            responses = self._batch(items)
+            for i, oid in enumerate(oids):
+                resp = responses.get(str(i)) or {}
+                status, body = resp.get("status"), resp.get("body") or {}
+                if status not in (200, 404):
+                    raise requests.HTTPError(f"{status} Error for manager {oid}")
+                found[oid] = _mail(body) if status == 200 else None
         else:
-            url = f"{GRAPH_BASE}/users/delta"
-            params = {"$select": base_select, "$top": 999}
+            for oid in oids:
+                r = self._request("GET", f"{self.graph_base}/users/{oid}", params={"$select": "mail,userPrincipalName"})
+                if r.status_code == 404:
+                    found[oid] = None
+                    continue
+                r.raise_for_status()
+                found[oid] = _mail(r.json())
+        return found
 
-        created = updated = deactivated = 0
-        notes = []
-        include_groups = self.d.include_groups
-        include_licenses = self.d.include_licenses
-        # Only pull/create enabled accounts? (safe if field not migrated yet)
-        only_active = getattr(self.d, "only_active", False)
-        # NEW: normalize allowed domains (if any)
-        allowed_set = set(
-            d.strip().lower()
-            for d in (self.d.allowed_domains or [])
-            if isinstance(d, str) and d.strip()
+    def _resolve_managers(self, prepared, pool, full_crawl):
+        """
+        Sets manager_email from the "manager@delta" ids on the page. A user without one kept
+        their manager (delta round) or has none (full crawl). Ids are resolved from the run's
+        ManagerCache, then from local users by azure_oid (one query), then from Graph.
+        """
+        wanted = []  # (obj, manager oid)
+        for u, obj, _ in prepared:
+            if "manager@delta" not in u:
+                if full_crawl:
+                    obj.manager_email = None
+                continue
+            # a change of manager may list the old one as @removed next to the new one
+            current = [ref.get("id") for ref in u["manager@delta"] or [] if "@removed" not in ref]
+            if current:
+                wanted.append((obj, current[0]))
+            else:
+                obj.manager_email = None
+        if not wanted:
+            return
+
+        cache = self.managers
+        source = dict.fromkeys(cache.unknown(oid for _, oid in wanted), "local")
+        if source:
+            local = User.objects.filter(identity_source="AZURE", azure_oid__in=list(source)).values_list("azure_oid", "email")
+            cache.add(dict(local))
+        missing = cache.unknown(source)
+        if missing:
+            chunks = [missing[i:i + BATCH_MAX] for i in range(0, len(missing), BATCH_MAX)]
+            for f in [pool.submit(self._manager_emails, chunk) for chunk in chunks]:
+                cache.add(f.result())
+            source.update(dict.fromkeys(missing, "graph"))
+        for obj, oid in wanted:
+            obj.manager_email = cache.get(oid, source.get(oid, "run"))
+
+    # --- full crawl with inline manager/licenses ---
+    def _latest_delta_link(self):
+        """A users/delta cursor for "now", without paging through the tenant."""
+        data = self._get(f"{self.graph_base}/users/delta", params={"$select": DELTA_SELECT, "$deltatoken": "latest"})
+        return data.get("@odata.deltaLink")
+
+    def _expanded_params(self):
+        return {
+            "$select": USER_SELECT + ",assignedLicenses",
+            "$expand": "manager($select=mail,userPrincipalName)",
+            "$top": EXPAND_PAGE_SIZE,
+        }
+
+    def _segment_links(self, n):
+        """
+        First-page URLs of n expanded /users listings that split the tenant by
+        userPrincipalName ranges. Bounds are single letters, which no UPN equals (a UPN
+        always has an "@"), so `ge`/`le` ranges cover every user exactly once.
+        """
+        n = max(1, min(n, len(SEGMENT_LETTERS)))
+        bounds = [SEGMENT_LETTERS[round(k * len(SEGMENT_LETTERS) / n)] for k in range(1, n)]
+        links = {}
+        for i in range(n):
+            clauses = []
+            if i > 0:
+                clauses.append(f"userPrincipalName ge '{bounds[i - 1]}'")
+            if i < n - 1:
+                clauses.append(f"userPrincipalName le '{bounds[i]}'")
+            params = self._expanded_params()
+            if clauses:
+                params["$filter"] = " and ".join(clauses)
+            links[str(i)] = f"{self.graph_base}/users?{urlencode(params)}"
+        return links
+
+    def _sku_map(self):
+        """skuId -> skuPartNumber for the tenant, fetched once per run."""
+        data = self._get(f"{self.graph_base}/subscribedSkus", params={"$select": "skuId,skuPartNumber"})
+        return {x.get("skuId"): x.get("skuPartNumber") for x in data.get("value", []) if x.get("skuPartNumber")}
+
+    def _inline_extras(self, u, sku_map):
+        """Extras read from the expanded manager and assignedLicenses (no extra calls)."""
+        mgr = u.get("manager") or {}
+        extras = {"manager_email": (mgr.get("mail") or mgr.get("userPrincipalName") or "").strip().lower() or None}
+        if self.d.include_licenses:
+            extras["licenses"] = [
+                sku_map[x.get("skuId")] for x in (u.get("assignedLicenses") or []) if x.get("skuId") in sku_map
+            ]
+        return extras
+
+    def _apply_user_fields(self, obj, u):
+        # identity + status
+        obj.identity_source = "AZURE"
+        # obj.is_active = bool(u.get("accountEnabled", True))
+        obj.azure_oid = u.get("id")
+        obj.tenant_id = self.d.credentials.get("tenant_id")
+
+        # org fields
+        obj.job_title = (u.get("jobTitle") or "").strip() or None
+        obj.department = (u.get("department") or "").strip() or None
+
+        # names
+        fn = (u.get("givenName") or "").strip()
+        ln = (u.get("surname") or "").strip()
+        if not fn and not ln and u.get("displayName"):
+            parts = u["displayName"].strip().split()
+            if parts:
+                fn = parts[0]
+                ln = " ".join(parts[1:])
+        # never None; AbstractUser uses null=False for these fields
+        obj.first_name = fn[:150]  # default max_length is 150
+        obj.last_name = ln[:150]
+
+    def _fingerprint(self, u):
+        """
+        Compact hash of a user's selected Graph attributes (USER_SELECT) plus the settings
+        that shape the stored row. Same hash as last time = the user's own fields, licenses
+        and groups need neither a write nor a re-fetch.
+
+        manager / manager@delta / assignedLicenses are left out: whether a page carries them
+        depends on how it was listed, not on the user (see _relations_changed).
+        """
+        payload = {}
+        for key in USER_SELECT.split(","):
+            value = u.get(key)
+            payload[key] = value.strip() if isinstance(value, str) else value
+        payload["_settings"] = [
+            self.d.include_licenses, self.d.include_groups, getattr(self.d, "group_sync_mode", "per_user"),
+            self.d.credentials.get("tenant_id"),
+        ]
+        raw = json.dumps(payload, sort_keys=True, separators=(",", ":"))
+        return hashlib.blake2b(raw.encode(), digest_size=16).hexdigest()
+
+    def _relations_changed(self, obj, u, sku_map):
+        """
+        True when the page says more about a user with an unchanged fingerprint than the
+        stored row holds: a manager@delta (sent on a change of manager) or, in an expanded
+        crawl, an inline manager / assignedLicenses that differ from the stored ones.
+        """
+        if "manager@delta" in u:
+            return True
+        if self.expanded:
+            return any(getattr(obj, field) != value for field, value in self._inline_extras(u, sku_map).items())
+        return False
+
+    def _fetch_extras(self, uids, pool):
+        """
+        Run the lookups for a page of users on the worker pool (network only, no DB access).
+        Returns {uid: extras dict or Exception}; the caller applies them in page order.
+        """
+        results = {}
+        if not self._extra_requests("_"):
+            return {uid: {} for uid in uids}  # everything came inline with the page
+        if getattr(self.d, "batch_requests", False):
+            per_envelope = max(1, BATCH_MAX // len(self._extra_requests("_")))
+            chunks = [uids[i:i + per_envelope] for i in range(0, len(uids), per_envelope)]
+            futures = [(chunk, pool.submit(self._enrich_batch, chunk)) for chunk in chunks]
+            for chunk, f in futures:
+                try:
+                    results.update(f.result())
+                except Exception as e:
+                    # the $batch call itself failed: every user in it counts as an error
+                    results.update({uid: e for uid in chunk})
+        else:
+            futures = [(uid, pool.submit(self._enrich_user, uid)) for uid in uids]
+            for uid, f in futures:
+                try:
+                    results[uid] = f.result()
+                except Exception as e:
+                    results[uid] = e
+        return results
+
+    def _sync_groups(self):
+        """
+        Fill User.groups_cache from a /groups/delta crawl instead of per-user getMemberGroups.
+        Without a cursor every user's list is rebuilt from scratch; with one, only the
+        member additions/removals Graph reports are applied, so an idle tenant costs one call.
+        Returns how many users had their groups changed.
+        """
+        full = not self.d.groups_delta_link
+        if full:
+            url, params = f"{self.graph_base}/groups/delta", {"$select": "id,members"}
+        else:
+            url, params = self.d.groups_delta_link, None
+
+        added, removed = defaultdict(set), defaultdict(set)  # user oid -> group ids
+        deleted_groups = set()
+        delta_url = None
+        for data in self._pages(url, params):
+            for g in data.get("value", []):
+                if "@removed" in g:
+                    deleted_groups.add(g["id"])
+                    continue
+                # big groups arrive split over several entries with the same id; sets merge them
+                for m in g.get("members@delta", []):
+                    if m.get("@odata.type", "#microsoft.graph.user") != "#microsoft.graph.user":
+                        continue  # nested groups, devices, service principals
+                    (removed if "@removed" in m else added)[m["id"]].add(g["id"])
+            delta_url = data.get("@odata.deltaLink") or delta_url
+
+        users = User.objects.filter(identity_source="AZURE", tenant_id=self.d.credentials.get("tenant_id"))
+        if not full and not deleted_groups:
+            users = users.filter(azure_oid__in=set(added) | set(removed))
+
+        changed = []
+        for obj in users.only("pk", "azure_oid", "groups_cache"):
+            if full:
+                groups = added.get(obj.azure_oid, set())
+            else:
+                groups = set(obj.groups_cache or [])
+                groups = (groups | added.get(obj.azure_oid, set())) - removed.get(obj.azure_oid, set()) - deleted_groups
+            groups = sorted(groups)
+            if groups != sorted(obj.groups_cache or []):
+                obj.groups_cache = groups
+                changed.append(obj)
+        # a transaction per batch: SQLite's single write lock is never held for the whole tenant
+        # (re-applying the same delta after a failure gives the same lists)
+        for i in range(0, len(changed), 500):
+            with transaction.atomic():
+                User.objects.bulk_update(changed[i:i + 500], ["groups_cache"])
+
+        if delta_url:
+            self.d.groups_delta_link = delta_url
+            self.d.save(update_fields=["groups_delta_link"])
+        return len(changed)
+
+    def _unseen_users(self, seen):
+        """
+        Active synced users of the tenant whose azure_oid a complete full crawl did not list
+        (they vanished while we had no delta cursor, so no @removed ever came).
+        See writer.unseen_users; the note is set when over deprovision_max_percent.
+        """
+        active = User.objects.filter(
+            identity_source="AZURE", tenant_id=self.d.credentials.get("tenant_id"),
+            is_active=True, azure_oid__isnull=False,
         )
+        return unseen_users(active, "azure_oid", seen, getattr(self.d, "deprovision_max_percent", 10))
+
+    def _deprovision_unseen(self, seen):
+        """Deactivates what _unseen_users reports, unless over the limit. Returns (deactivated, note)."""
+        missing, over_limit = self._unseen_users(seen)
+        if over_limit or not missing:
+            return 0, over_limit
+        n = deactivate([pk for pk, _, _ in missing])
+        return n, f"deprovisioned {n} users not seen in the full crawl"
+
+    # --- dry run (BaseSyncer.plan): the whole tenant via /users, no per-user lookups ---
+    def _listing(self):
+        return self._pages(f"{self.graph_base}/users", {"$select": USER_SELECT, "$top": 999})
+
+    @staticmethod
+    def _page_users(data):
+        return data.get("value", [])
+
+    @staticmethod
+    def _email(u):
+        return _mail(u)
+
+    @staticmethod
+    def _enabled(u):
+        return bool(u.get("accountEnabled", True))
+
+    @staticmethod
+    def _external_id(u):
+        return u.get("id")
+
+    _seen_key = _external_id
+
+    def test_connection(self):
+        self._open_session()
+        try:
+            # simple call
+            _ = self._get(f"{self.graph_base}/organization")
+        finally:
+            self._close_session()
+        return True
+
+    # --- change notifications (manage.py graph_subscriptions) ---
+    def subscribe(self, notification_url):
+        """
+        Creates or renews this tenant's change-notification subscriptions (users, plus groups
+        when memberships come from groups/delta) for notification_url and saves them in
+        graph_subscriptions. In per_user group mode a groups notification would only start a
+        users/delta run, which does not see membership changes, so groups are not subscribed.
+        Graph validates the URL before creating one (see views.graph_notifications).
+        Subscriptions for another URL or an unused resource are deleted; one Graph no longer
+        knows is created again. Returns [(resource, "created" / "renewed" / "removed"), ...].
+        """
+        expires = (timezone.now() + timedelta(minutes=SUBSCRIPTION_MINUTES)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        resources = ["users"] + (["groups"] if self.d.include_groups and not self._per_user_groups() else [])
+        kept, done = [], []
+        self._open_session()
+        try:
+            for sub in self.d.graph_subscriptions or []:
+                url = f"{self.graph_base}/subscriptions/{sub['id']}"
+                if sub.get("resource") not in resources or sub.get("notificationUrl") != notification_url:
+                    r = self._request("DELETE", url)
+                    if r.status_code != 404:
+                        r.raise_for_status()
+                    done.append((sub.get("resource"), "removed"))
+                    continue
+                r = self._request("PATCH", url, json={"expirationDateTime": expires})
+                if r.status_code == 404:
+                    continue  # expired or deleted on Graph's side: created again below
+                r.raise_for_status()
+                kept.append(dict(sub, expirationDateTime=expires))
+                done.append((sub["resource"], "renewed"))
 
-        def apply_user_fields(obj, u):
-            # identity + status
-            obj.identity_source = "AZURE"
-            # obj.is_active = bool(u.get("accountEnabled", True))
-            obj.azure_oid = u.get("id")
-            obj.tenant_id = self.d.credentials.get("tenant_id")
-
-            # org fields
-            obj.job_title = (u.get("jobTitle") or "").strip() or None
-            obj.department = (u.get("department") or "").strip() or None
-
-            # names
-            fn = (u.get("givenName") or "").strip()
-            ln = (u.get("surname") or "").strip()
-            if not fn and not ln and u.get("displayName"):
-                parts = u["displayName"].strip().split()
-                if parts:
-                    fn = parts[0]
-                    ln = " ".join(parts[1:])
-            # never None; AbstractUser uses null=False for these fields
-            obj.first_name = fn[:150]  # default max_length is 150
-            obj.last_name = ln[:150]
+            for resource in resources:
+                if any(sub["resource"] == resource for sub in kept):
+                    continue
+                data = self._post(f"{self.graph_base}/subscriptions", json={
+                    "changeType": SUBSCRIPTION_CHANGE_TYPES,
+                    "notificationUrl": notification_url,
+                    "resource": resource,
+                    "expirationDateTime": expires,
+                    "clientState": self.d.notification_client_state,
+                })
+                kept.append({
+                    "id": data["id"], "resource": resource, "notificationUrl": notification_url,
+                    "expirationDateTime": data.get("expirationDateTime") or expires,
+                })
+                done.append((resource, "created"))
+        finally:
+            self._close_session()
+        self.d.graph_subscriptions = kept
+        self.d.save(update_fields=["graph_subscriptions"])
+        return done
+
+    def unsubscribe(self):
+        """Deletes every subscription in graph_subscriptions (polling only from then on)."""
+        self._open_session()
+        try:
+            for sub in self.d.graph_subscriptions or []:
+                r = self._request("DELETE", f"{self.graph_base}/subscriptions/{sub['id']}")
+                if r.status_code != 404:
+                    r.raise_for_status()
+        finally:
+            self._close_session()
+        n = len(self.d.graph_subscriptions or [])
+        self.d.graph_subscriptions = []
+        self.d.save(update_fields=["graph_subscriptions"])
+        return n
+
+    def _sync(self, pool):
+
+        # Continue an interrupted crawl, else start from saved delta_link if present,
+        # else do an initial delta crawl
+        self.expanded = False
+        self.checkpoint_rejected = False
+        self.managers = ManagerCache()
+        handoff_link = sku_map = None
+        segments = None  # segment -> URL of its next page, during a segmented crawl
+        checkpoint = getattr(self.d, "crawl_checkpoint", None) or {}
+        page_no = 0
+        # a crawl without a cursor lists the whole tenant: remember who was in it
+        resuming = checkpoint.get("next_link") or checkpoint.get("segments")
+        full_crawl = bool(checkpoint.get("full")) if resuming else not self.d.delta_link
+        with self.metrics.phase("setup"):
+            if checkpoint.get("next_link"):
+                url, params = checkpoint["next_link"], None
+                page_no = checkpoint.get("page", 0)
+                handoff_link = checkpoint.get("handoff_link")
+                self.expanded = bool(checkpoint.get("expanded"))
+                if self.expanded:
+                    sku_map = self._sku_map() if self.d.include_licenses else {}
+            elif checkpoint.get("segments"):
+                segments = dict(checkpoint["segments"])
+                page_no = checkpoint.get("page", 0)
+                handoff_link = checkpoint.get("handoff_link")
+                self.expanded = True
+                sku_map = self._sku_map() if self.d.include_licenses else {}
+            elif self.d.delta_link:
+                url = self.d.delta_link
+                params = None  # deltaLink already encodes params
+            elif (getattr(self.d, "crawl_segments", 1) or 1) > 1:
+                # initial/forced crawl of a big tenant: UPN ranges listed side by side, each an
+                # expanded /users stream; same handoff cursor as the serial expanded crawl
+                handoff_link = self._latest_delta_link()
+                sku_map = self._sku_map() if self.d.include_licenses else {}
+                self.expanded = True
+                segments = self._segment_links(self.d.crawl_segments)
+            elif getattr(self.d, "expand_full_crawl", False):
+                # initial/forced crawl: one paged /users stream with manager + licenses inline.
+                # The delta cursor is taken *before* listing so changes made meanwhile are not lost.
+                handoff_link = self._latest_delta_link()
+                sku_map = self._sku_map() if self.d.include_licenses else {}
+                self.expanded = True
+                url = f"{self.graph_base}/users"
+                params = self._expanded_params()
+            else:
+                url = f"{self.graph_base}/users/delta"
+                params = {"$select": DELTA_SELECT, "$top": 999}
+
+        created = updated = deactivated = skipped = 0
+        field_changes = Counter()  # updated rows per written column
+        lookup_failures = Counter()  # licenses / groups lookups that failed after all retries
+        notes = []
 
         # collect errors across the whole run (all pages)
         errors_total = 0
         sample_errors = []
 
-        while True:
-            data = self._get(url, token, params=params)
+        def note_error(u, e):
+            nonlocal errors_total
+            errors_total += 1
+            if len(sample_errors) < 5:
+                ident = (u.get("mail") or u.get("userPrincipalName") or u.get("id") or "<unknown>")
+                sample_errors.append(f"{ident}: {e.__class__.__name__}: {e}")
+
+        # page N+1 downloads in the background while page N is enriched and written
+        depth = getattr(settings, "DIRECTORY_SYNC_PREFETCH_PAGES", 2)
+        if segments is not None:
+            # one fetcher thread per segment, all under the shared rate limiter; pages are
+            # written in arrival order by this thread
+            keys = list(segments)
+            sources = [self._resumed_pages(segments[k]) if page_no else self._pages(segments[k]) for k in keys]
+            stream = ((keys[i], data) for i, data in merge(sources, depth))
+            notes.append(f"segmented crawl: {len(keys)} userPrincipalName ranges in parallel")
+        else:
+            pages = self._resumed_pages(url) if page_no else self._pages(url, params)
+            stream = ((None, data) for data in prefetch(pages, depth))
+        if page_no:
+            stream = self._dropping_rejected_checkpoint(stream)
+            notes.append(f"resumed from checkpoint at page {page_no + 1}")
+        # oids seen by this run, for set-difference deprovisioning. Pages before a checkpoint
+        # were seen by an earlier run, so a resumed crawl cannot tell who is missing.
+        seen = set() if full_crawl and not page_no and self.d.deprovision_missing else None
+        # per-user licenses/groups are not part of the fingerprint: a full (forced) crawl
+        # re-fetches them for everybody, only delta rounds trust the fingerprint alone
+        refresh_extras = full_crawl and bool(self._extra_requests("_"))
+        for segment, data in self.metrics.timed(stream, "fetch"):
+            self.metrics.lap()
 
+            candidates = []  # (graph user, email, enabled) to create/update
+            removed_oids = []  # @removed entries
+            filtered_emails = []  # disabled / out-of-domain accounts we only deactivate
             for u in data.get("value", []):
                 try:
+                    if seen is not None and "@removed" not in u:
+                        seen.add(u.get("id"))
+
                     # 1) delta removals
                     if "@removed" in u:
                         if self.d.deprovision_missing:
-                            q = User.objects.filter(identity_source="AZURE", azure_oid=u.get("id"))
-                            deactivated += q.update(is_active=False)
+                            removed_oids.append(u.get("id"))
                         continue
 
                     # 2) basic identity
@@ -108,112 +755,202 @@ class AzureSyncer:
                     if not email:
                         # skip users with no usable email
                         continue
+                    # anyone listed may be somebody's manager later in the crawl
+                    self.managers.learn(u.get("id"), email)
 
                     # NEW: respect "only_active"
                     enabled = bool(u.get("accountEnabled", True))
 
-                    # A) Only active: skip creating disabled, deactivate existing
-                    if only_active and not enabled:
-                        try:
-                            obj = User.objects.get(email=email)
-                            if obj.identity_source == "AZURE" and obj.is_active:
-                                obj.is_active = False
-                                obj.save(update_fields=["is_active"])
-                                deactivated += 1
-                        except User.DoesNotExist:
-                            pass
+                    # skip disabled / out-of-domain accounts; deactivate them if they already exist
+                    if self._filtered_out(email, enabled):
+                        filtered_emails.append(email)
                         continue
 
-                    # B) Allowed domains: skip outside; deactivate if it already exists
-                    if allowed_set:
-                        domain = email.split("@")[-1]
-                        if domain not in allowed_set:
-                            try:
-                                obj = User.objects.get(email=email)
-                                if obj.identity_source == "AZURE" and obj.is_active:
-                                    obj.is_active = False
-                                    obj.save(update_fields=["is_active"])
-                                    deactivated += 1
-                            except User.DoesNotExist:
-                                pass
-                            continue
+                    candidates.append((u, email, enabled))
+
+                except Exception as e:
+                    # log and continue with the next user
+                    note_error(u, e)
+                    continue  # keep processing the rest
 
-                    obj, is_created = User.objects.get_or_create(
-                        email=email,
-                        # defaults={"identity_source": "AZURE", "is_active": bool(u.get("accountEnabled", True))},
-                        defaults={"identity_source": "AZURE", "is_active": enabled},
-                    )
-                    # Make sure newly created users are marked with an unusable password so password login can’t work by accident.
-                    if is_created:
-                        obj.set_unusable_password()  # ⬅️ ensures password auth can’t be used
+            # deactivations for the whole page: one UPDATE each, counting only rows that flip
+            if removed_oids:
+                deactivated += User.objects.filter(
+                    identity_source="AZURE", azure_oid__in=removed_oids, is_active=True,
+                ).update(is_active=False)
+            if filtered_emails:
+                deactivated += User.objects.filter(
+                    identity_source="AZURE", email__in=filtered_emails, is_active=True,
+                ).update(is_active=False)
+
+            # one query for every existing row on this page (by email or azure_oid)
+            writer = PageWriter("AZURE", oid_field="azure_oid")
+            writer.load((email, u.get("id")) for u, email, _ in candidates)
+
+            prepared = []  # (graph user, unsaved User, is_created) waiting for extras
+            keep_extras = set()  # ids whose own fields are unchanged: stored licenses/groups still hold
+            for u, email, enabled in candidates:
+                try:
+                    obj, is_created = writer.get(email, u.get("id"), is_active=enabled)
+
+                    # unchanged since the last sync: no write, no manager/license/group calls
+                    fingerprint = self._fingerprint(u)
+                    if (not is_created and not refresh_extras and obj.directory_fingerprint == fingerprint
+                            and obj.identity_source == "AZURE" and obj.is_active == enabled):
+                        if not self._relations_changed(obj, u, sku_map):
+                            skipped += 1
+                            continue
+                        keep_extras.add(u.get("id"))  # only the manager (or inline licenses) moved
+                    obj.directory_fingerprint = fingerprint
 
                     # mirror current status on updates too
                     obj.is_active = enabled
 
                     # 3) map fields (names included; never None for names)
-                    apply_user_fields(obj, u)
+                    self._apply_user_fields(obj, u)
+                    if self.expanded:
+                        for field, value in self._inline_extras(u, sku_map).items():
+                            setattr(obj, field, value)
 
-                    # 4) optional extras (only for changed users)
-                    # manager
-                    manager_email = None
-                    try:
-                        mgr = self._get(f"{GRAPH_BASE}/users/{u['id']}/manager", token)
-                        manager_email = (mgr.get("mail") or mgr.get("userPrincipalName") or "").strip().lower() or None
-                    except requests.HTTPError as e:
-                        if e.response.status_code != 404:
-                            raise
-                    obj.manager_email = manager_email
-
-                    # licenses
-                    if include_licenses:
-                        try:
-                            lic = self._get(f"{GRAPH_BASE}/users/{u['id']}/licenseDetails", token)
-                            obj.licenses = [x.get("skuPartNumber") for x in lic.get("value", []) if
-                                            x.get("skuPartNumber")]
-                        except requests.HTTPError:
-                            # ignore per-user license errors
-                            pass
-
-                    # groups
-                    if include_groups:
-                        try:
-                            r = requests.post(
-                                f"{GRAPH_BASE}/users/{u['id']}/getMemberGroups",
-                                headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"},
-                                json={"securityEnabledOnly": False},
-                            )
-                            if r.status_code == 200:
-                                obj.groups_cache = r.json().get("value", [])
-                        except requests.HTTPError:
-                            # ignore per-user group errors
-                            pass
-
-                    # 5) save and count
-                    obj.save()
-                    created += int(is_created)
-                    updated += int(not is_created)
+                    prepared.append((u, obj, is_created))
 
                 except Exception as e:
-                    # log and continue with the next user
-                    errors_total += 1
-                    if len(sample_errors) < 5:
-                        ident = (u.get("mail") or u.get("userPrincipalName") or u.get("id") or "<unknown>")
-                        sample_errors.append(f"{ident}: {e.__class__.__name__}: {e}")
-                    continue  # keep processing the rest
+                    note_error(u, e)
 
-            # paging / delta handling
-            next_url = data.get("@odata.nextLink")
+            # managers from manager@delta ids, resolved locally first
+            if not self.expanded and prepared:
+                try:
+                    self._resolve_managers(prepared, pool, full_crawl)
+                except Exception as e:
+                    for u, _, _ in prepared:
+                        note_error(u, e)
+                    prepared = []
+
+            # 4) optional extras (only for changed users), fetched in parallel
+            self.metrics.lap("prepare")
+            extras_by_id = self._fetch_extras([u["id"] for u, _, _ in prepared if u["id"] not in keep_extras], pool)
+            self.metrics.lap("enrich")
+
+            # 5) single writer: apply extras in page order so counters and error samples stay stable
+            ready = []
+            for u, obj, is_created in prepared:
+                try:
+                    if u["id"] in keep_extras:
+                        ready.append((u, obj, is_created))
+                        continue
+                    extras = extras_by_id[u["id"]]
+                    if isinstance(extras, Exception):
+                        raise extras
+                    # a failed lookup keeps the stored value; the user's own fields are still written
+                    for kind, e in extras.get("failed", {}).items():
+                        lookup_failures[kind] += 1
+                        note_error(u, e)
+                    for field, value in extras.items():
+                        if field != "failed":
+                            setattr(obj, field, value)
+                    # a failed lookup must not be frozen in by the fingerprint
+                    if ((self.d.include_licenses and not self.expanded and "licenses" not in extras)
+                            or (self._per_user_groups() and "groups_cache" not in extras)):
+                        obj.directory_fingerprint = None
+                    ready.append((u, obj, is_created))
+                except Exception as e:
+                    note_error(u, e)
+
+            # 6) one transaction per page: bulk_create new rows, bulk_update the rest
+            try:
+                writer.save([obj for _, obj, _ in ready])
+            except Exception:
+                # one bad row (e.g. an email clash) must not cost the whole page: retry row by row
+                saved = []
+                for u, obj, is_created in ready:
+                    try:
+                        writer.save_one(obj)
+                        saved.append((u, obj, is_created))
+                    except Exception as e:
+                        note_error(u, e)
+                ready = saved
+            for _, obj, is_created in ready:
+                if is_created:
+                    created += 1
+                elif obj.pk in writer.unchanged:
+                    skipped += 1  # identical to the stored row: nothing written
+                else:
+                    updated += 1
+            field_changes.update(writer.field_changes)
+
+            # checkpoint: this page is committed, a crash from here on resumes at the next one
+            # (a streamed page comes in pieces; only its last piece carries the nextLink)
+            if data.get("@odata.nextLink") and segments is not None:
+                # a finished segment keeps the link of its last page, re-read (and skipped) on resume
+                page_no += 1
+                segments[segment] = data["@odata.nextLink"]
+                self._save_checkpoint({
+                    "segments": segments,
+                    "page": page_no,
+                    "handoff_link": handoff_link,
+                    "full": full_crawl,
+                })
+            elif data.get("@odata.nextLink"):
+                page_no += 1
+                self._save_checkpoint({
+                    "next_link": data["@odata.nextLink"],
+                    "page": page_no,
+                    "expanded": self.expanded,
+                    "handoff_link": handoff_link,
+                    "full": full_crawl,
+                })
+
+            # delta handling (the last page carries the new cursor)
             delta_url = data.get("@odata.deltaLink")
-            if next_url:
-                url, params = next_url, None
-                continue
             if delta_url:
                 self.d.delta_link = delta_url
                 self.d.save(update_fields=["delta_link"])
-            break
+            self.metrics.lap("write")
+
+        # full crawl done: later runs continue from the cursor taken before it started
+        if handoff_link:
+            self.d.delta_link = handoff_link
+            self.d.save(update_fields=["delta_link"])
+        if self.d.crawl_checkpoint:
+            self._save_checkpoint({})
+        self.expanded = False
+
+        # full crawl: whoever we have that Graph did not list is gone
+        if seen is not None:
+            with self.metrics.phase("deprovision"):
+                n, note = self._deprovision_unseen(seen)
+            deactivated += n
+            if note:
+                notes.append(note)
+        elif full_crawl and self.d.deprovision_missing:
+            notes.append("full crawl resumed from a checkpoint: missing users not deprovisioned this time")
+
+        # group memberships in bulk, after the users they point at exist
+        if self.d.include_groups and not self._per_user_groups():
+            with self.metrics.phase("groups"):
+                notes.append(f"groups delta: {self._sync_groups()} users' groups changed")
+
+        if self.managers.lookups:
+            stats = self.metrics.extra["manager_cache"] = self.managers.stats()
+            notes.append(
+                f"managers: {stats['lookups']} lookups, {stats['graph_lookups']} from Graph, "
+                f"hit rate {stats['hit_rate']:.0%}"
+            )
+
+        if lookup_failures:
+            self.metrics.extra["lookup_failures"] = dict(lookup_failures)
+
+        if field_changes:
+            self.metrics.extra["field_changes"] = dict(field_changes.most_common())
+            note = field_changes_note(field_changes)
+            if note:
+                notes.append(note)
 
         # attach error summary to notes (shown in admin)
         if errors_total:
             notes.append(f"errors={errors_total}; samples: " + "; ".join(sample_errors))
 
-        return dict(created=created, updated=updated, deactivated=deactivated, notes="\n".join(notes))
+        return dict(
+            created=created, updated=updated, deactivated=deactivated, skipped=skipped,
+            throttle_wait=round(self.throttle_wait, 1), notes="\n".join(notes),
+        )
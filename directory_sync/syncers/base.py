@@ -1,4 +1,227 @@
+import threading, time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import connection
+from accounts.models import User
+from ..tokens import BearerAuth, get_token_provider
+from .http import build_session, request_repeatable, request_timeout
+from .pipeline import prefetch
+from .ratelimit import THROTTLE_STATUSES, backoff_seconds, get_limiter
+from .telemetry import RunMetrics
+from .writer import PageWriter
+
+
 class BaseSyncer:
-    def __init__(self, directory): self.directory = directory
-    def test_connection(self): raise NotImplementedError
-    def sync(self): raise NotImplementedError  # return dict(created=.., updated=.., deactivated=.., notes="..")
+    """
+    What every directory syncer shares: the pooled session of a run, rate-limited requests
+    with Retry-After handling, the only_active / allowed_domains filters, the sync() wrapper
+    (worker pool, DB telemetry, job metrics) and the dry-run plan().
+
+    A subclass sets the class attributes below and implements test_connection(), _sync(pool)
+    -> dict(created=.., updated=.., deactivated=.., skipped=.., notes=".."), and the hooks
+    plan() lists and compares with: _listing(), _page_users(), _email(), _enabled(),
+    _external_id(), _seen_key(), _apply_user_fields() and _unseen_users().
+    """
+
+    provider = None  # names the worker threads
+    identity_source = None  # User.identity_source of the rows this syncer owns
+    oid_field = None  # User column holding the directory's user id, if it has one
+    plan_fields = None  # the columns a dry run compares
+    plan_note = ""  # what a dry run does not compare
+
+    def __init__(self, directory, limiter_key):
+        self.d = directory
+        self.http = None  # pooled session, open only for the duration of a run
+        self.token_provider = None  # the session's, see _open_session
+        self.limiter = get_limiter(limiter_key)
+        self.throttle_wait = 0.0  # seconds this run spent held back by the limiter / Retry-After
+        self._wait_lock = threading.Lock()
+        self.metrics = None  # RunMetrics of the current sync() run
+        self._allowed_set = None  # normalized allowed_domains, built on first use
+
+    def test_connection(self):
+        raise NotImplementedError
+
+    # --- HTTP ---
+    def _open_session(self):
+        provider = get_token_provider(self.d)
+        provider.token()  # fail fast on bad credentials, before any API call
+        provider.persist()  # token cache writes stay on this thread, never on a worker
+        self.http = build_session(auth=BearerAuth(provider), verify=self.d.credentials.get("ca_bundle") or True)
+        self.token_provider = provider
+        return self.http
+
+    def _close_session(self):
+        summary = self.http.stats.summary()
+        self.http.close()
+        self.token_provider.persist()  # a token refreshed during the run
+        self.http = None
+        return summary
+
+    def _is_throttled(self, r):
+        return r.status_code in THROTTLE_STATUSES
+
+    def _request(self, method, url, repeatable=False, **kwargs):
+        """
+        Every API call goes through here: wait for the rate limiter shared by all threads and
+        runs on this tenant, then retry throttled responses (_is_throttled) after Retry-After
+        (or jittered backoff), slowing the limiter down. Returns the last response, whatever
+        its status; only a response that is not throttled counts as a success for the limiter.
+        repeatable: a POST that only reads, retried on transport errors like a GET.
+        """
+        kwargs.setdefault("timeout", request_timeout())
+        max_attempts = getattr(settings, "DIRECTORY_SYNC_GRAPH_MAX_ATTEMPTS", 6)
+        for attempt in range(1, max_attempts + 1):
+            self._add_wait(self.limiter.acquire())
+            if repeatable and method != "GET":
+                r = request_repeatable(self.http, method, url, **kwargs)
+            else:
+                r = self.http.request(method, url, **kwargs)
+            if not kwargs.get("stream"):
+                self.http.stats.add_bytes(len(r.content))  # streamed bodies are counted as they are read
+            if self._is_throttled(r):
+                if attempt == max_attempts:
+                    return r  # still throttled: the caller fails it, the limiter stays slow
+                r.close()
+                self.limiter.throttled(backoff_seconds(r.headers.get("Retry-After"), attempt))
+                continue
+            self.limiter.succeeded()
+            return r
+
+    def _add_wait(self, seconds):
+        if seconds:
+            with self._wait_lock:
+                self.throttle_wait += seconds
+
+    # --- listing ---
+    def _filtered_out(self, email, enabled):
+        """True for accounts the directory settings exclude: never created, deactivated if present."""
+        # A) Only active: skip disabled accounts (safe if field not migrated yet)
+        if getattr(self.d, "only_active", False) and not enabled:
+            return True
+        # B) Allowed domains: skip everything outside them (if any are set)
+        if self._allowed_set is None:
+            self._allowed_set = set(
+                d.strip().lower()
+                for d in (self.d.allowed_domains or [])
+                if isinstance(d, str) and d.strip()
+            )
+        return bool(self._allowed_set) and email.split("@")[-1] not in self._allowed_set
+
+    def _split_page(self, data, seen):
+        """
+        (candidates [(user, email, enabled)], filtered {email: external id}) for one listed
+        page; the _seen_key of every listed user goes into `seen`.
+        """
+        candidates, filtered = [], {}
+        for u in self._page_users(data):
+            key = self._seen_key(u)
+            if key:
+                seen.add(key)
+            email = self._email(u)
+            if not email:
+                continue
+            enabled = self._enabled(u)
+            if self._filtered_out(email, enabled):
+                filtered[email] = self._external_id(u)
+            else:
+                candidates.append((u, email, enabled))
+        return candidates, filtered
+
+    # --- interface ---
+    def sync(self):
+        self.metrics = RunMetrics()
+        with self.metrics.phase("token"):
+            self._open_session()
+        stats = self.http.stats
+        workers = max(1, getattr(self.d, "enrichment_workers", 1) or 1)
+        pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"{self.provider}-enrich")
+        try:
+            # DB statements of this thread (the single writer) are counted and timed
+            with connection.execute_wrapper(self.metrics.db):
+                result = self._sync(pool)
+        finally:
+            pool.shutdown(cancel_futures=True)
+            http_summary = self._close_session()
+        # per-call latency, shown in the job notes; the full breakdown goes to SyncJob.metrics
+        result["notes"] = "\n".join(x for x in (result.get("notes"), http_summary) if x)
+        result["metrics"] = self.metrics.as_dict(stats, self.throttle_wait)
+        return result
+
+    def _sync(self, pool):
+        raise NotImplementedError
+
+    def plan(self):
+        """
+        What a sync would change right now, without writing anything.
+
+        Lists the whole directory (_listing(); a delta cursor or checkpoint is neither used
+        nor moved), compares each page with the local rows in one read-only query and returns
+        {"summary": {...}, "changes": [{"action", "email", "external_id", "field", "old", "new"}, ...]}
+        with one change per field. Only plan_fields are compared: what needs per-user lookups
+        is left out (plan_note).
+        """
+        t0 = time.perf_counter()
+        counts, field_counts = Counter(), Counter()
+        changes, notes = [], [self.plan_note]
+        seen = set()
+
+        def change(action, email, external_id, field, old, new):
+            changes.append({
+                "action": action, "email": email, "external_id": external_id, "field": field, "old": old, "new": new,
+            })
+
+        self._open_session()
+        try:
+            for data in prefetch(self._listing(), getattr(settings, "DIRECTORY_SYNC_PREFETCH_PAGES", 2)):
+                candidates, filtered = self._split_page(data, seen)
+                if filtered:
+                    active = User.objects.filter(identity_source=self.identity_source, email__in=list(filtered), is_active=True)
+                    for email in active.values_list("email", flat=True):
+                        counts["deactivate"] += 1
+                        change("deactivate", email, filtered[email], "is_active", True, False)
+
+                writer = PageWriter(self.identity_source, oid_field=self.oid_field, fields=self.plan_fields)
+                writer.load((email, self._external_id(u)) for u, email, _ in candidates)
+                handled = set()
+                for u, email, enabled in candidates:
+                    obj, is_created = writer.get(email, self._external_id(u), is_active=enabled)
+                    if id(obj) in handled:
+                        continue  # listed twice on one page
+                    handled.add(id(obj))
+                    obj.is_active = enabled
+                    self._apply_user_fields(obj, u)
+                    diff = writer.changes(obj)
+                    if not diff:
+                        counts["unchanged"] += 1
+                        continue
+                    action = "create" if is_created else "update"
+                    counts[action] += 1
+                    for field, (old, new) in diff.items():
+                        if not is_created:
+                            field_counts[field] += 1
+                        change(action, email, self._external_id(u), field, old, new)
+        finally:
+            self._close_session()
+
+        if self.d.deprovision_missing:
+            missing, over_limit = self._unseen_users(seen)
+            if over_limit:
+                notes.append(over_limit)
+            else:
+                for _, email, key in missing:
+                    counts["deactivate"] += 1
+                    change("deactivate", email, key if self.oid_field else None, "is_active", True, False)
+
+        summary = {
+            "listed": len(seen),
+            "create": counts["create"],
+            "update": counts["update"],
+            "deactivate": counts["deactivate"],
+            "unchanged": counts["unchanged"],
+            "fields": dict(field_counts.most_common()),
+            "seconds": round(time.perf_counter() - t0, 1),
+            "notes": notes,
+        }
+        return {"summary": summary, "changes": changes}
@@ -0,0 +1,136 @@
+import math, re, threading, time
+from collections import Counter
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from django.conf import settings
+
+_VERSION_SEGMENT = re.compile(r"^(v\d+(\.\d+)?|beta)$")
+_COLLECTIONS = {"users", "groups"}
+TRANSPORT_RETRY_STATUSES = (500, 502)
+
+
+def endpoint_label(url):
+    """
+    Groups calls by API endpoint: "/users/8f3c…/manager" -> "/users/{id}/manager".
+    The API version prefix and the query string are dropped.
+    """
+    segments = [x for x in urlsplit(url).path.split("/") if x]
+    if segments and _VERSION_SEGMENT.match(segments[0]):
+        segments = segments[1:]
+    out = []
+    for i, seg in enumerate(segments):
+        after_collection = i > 0 and segments[i - 1] in _COLLECTIONS
+        if after_collection and seg != "delta" and not seg.startswith("$"):
+            seg = "{id}"
+        out.append(seg)
+    return "/" + "/".join(out)
+
+
+class CallStats:
+    """Counts calls, time-to-response and bytes for every request made through one session."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        self.latencies_ms = []
+        self.by_endpoint = Counter()
+
+    def record(self, response, *args, **kwargs):
+        ms = response.elapsed.total_seconds() * 1000
+        with self._lock:
+            self.calls += 1
+            self.seconds += ms / 1000
+            self.latencies_ms.append(ms)
+            self.by_endpoint[endpoint_label(response.url)] += 1
+
+    def add_bytes(self, n):
+        with self._lock:
+            self.bytes += n
+
+    def percentile(self, p):
+        """Nearest-rank percentile of the call latencies, in ms (0 without calls)."""
+        with self._lock:
+            values = sorted(self.latencies_ms)
+        if not values:
+            return 0.0
+        return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+    def summary(self):
+        avg_ms = (self.seconds / self.calls * 1000) if self.calls else 0
+        return f"http: calls={self.calls}, avg={avg_ms:.0f}ms per call, p95={self.percentile(95):.0f}ms"
+
+
+def request_timeout():
+    """
+    Timeout of every directory API call, in seconds (DIRECTORY_SYNC_HTTP_TIMEOUT, default 60;
+    a (connect, read) pair works too). The read timeout applies to each socket read, so a
+    long streamed page is fine, while a half-open connection fails instead of hanging the run.
+    """
+    return getattr(settings, "DIRECTORY_SYNC_HTTP_TIMEOUT", 60)
+
+
+def transport_retries():
+    """Retries of a call that failed in transport (DIRECTORY_SYNC_HTTP_RETRIES, default 3)."""
+    return getattr(settings, "DIRECTORY_SYNC_HTTP_RETRIES", 3)
+
+
+def request_repeatable(session, method, url, **kwargs):
+    """
+    session.request for a POST that only reads (a $batch of GETs, getMemberGroups): retried
+    on read errors and 500/502 the way build_session's adapter retries GETs. Never for a
+    call that changes something: a retry after a lost response would do it twice.
+    """
+    retries = transport_retries()
+    for attempt in range(retries + 1):
+        try:
+            r = session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == retries:
+                raise
+        else:
+            if r.status_code not in TRANSPORT_RETRY_STATUSES or attempt == retries:
+                return r
+            r.close()
+        time.sleep(0.5 * 2 ** attempt)  # the adapter's backoff_factor
+
+
+def build_session(headers=None, auth=None, pool_size=None, retries=None, verify=True):
+    """
+    One keep-alive session for a whole sync run.
+    requests has no session-wide timeout: callers pass request_timeout() on every call.
+    - auth: requests auth hook (e.g. BearerAuth) applied to every call
+    - verify: TLS verification, or a CA bundle path (private CA / local stand-in server)
+    - pool_size: max open connections per host (DIRECTORY_SYNC_HTTP_POOL_SIZE, default 10)
+    - retries: transport-level retries for connection errors, read timeouts and 500/502 (DIRECTORY_SYNC_HTTP_RETRIES, default 3).
+      Only GETs are repeated once sent (a POST may have created something); read-only POSTs
+      go through request_repeatable. 429/503/504 are left to the caller's rate limiter,
+      which honors Retry-After itself.
+    """
+    pool_size = pool_size or getattr(settings, "DIRECTORY_SYNC_HTTP_POOL_SIZE", 10)
+    retries = transport_retries() if retries is None else retries
+
+    retry = Retry(
+        total=retries,
+        backoff_factor=0.5,
+        status_forcelist=TRANSPORT_RETRY_STATUSES,
+        allowed_methods=frozenset({"GET"}),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+    s = requests.Session()
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    s.headers.update(headers or {})
+    s.auth = auth
+    s.verify = verify
+    if verify is not True:
+        # an explicit CA bundle must win over REQUESTS_CA_BUNDLE/CURL_CA_BUNDLE in the environment
+        s.trust_env = False
+    s.stats = CallStats()
+    s.hooks["response"].append(s.stats.record)
+    return s
@@ -0,0 +1,96 @@
+import codecs, json
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+
+
+class _Buffer:
+    """Text decoded so far from a byte stream, with a read position; consumed text is dropped."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.text = ""
+        self.pos = 0
+        self.eof = False
+
+    def more(self):
+        """Reads the next chunk; False once the stream is exhausted."""
+        if self.eof:
+            return False
+        if self.pos > 65536:
+            self.text, self.pos = self.text[self.pos:], 0
+        for chunk in self.chunks:
+            if chunk:
+                self.text += self.utf8.decode(chunk)
+                return True
+        self.text += self.utf8.decode(b"", final=True)
+        self.eof = True
+        return False
+
+    def peek(self):
+        """Next non-whitespace character (not consumed), "" at the end of the stream."""
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.more():
+                return ""
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"expected {char!r} at offset {self.pos} of the JSON stream")
+        self.pos += 1
+
+    def value(self):
+        """Decodes one complete JSON value, reading more of the stream until it is complete."""
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.text, self.pos)
+            except json.JSONDecodeError:
+                if self.more():
+                    continue
+                raise
+            # a number at the very end of the buffer may continue in the next chunk
+            if end == len(self.text) and not self.eof and self.more():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_object(chunks, array_key="value"):
+    """
+    Incrementally decodes a JSON object read from byte chunks (e.g. Response.iter_content).
+
+    Yields (array_key, item) for each element of the array under `array_key` as soon as
+    it is complete, and (key, value) for every other top-level member, in stream order.
+    Only one element is held at a time, so memory does not grow with the array length.
+    """
+    buf = _Buffer(chunks)
+    buf.expect("{")
+    while True:
+        char = buf.peek()
+        if char == "}":
+            return
+        if char == ",":
+            buf.pos += 1
+            continue
+        key = buf.value()
+        buf.expect(":")
+        if key == array_key and buf.peek() == "[":
+            buf.pos += 1
+            while True:
+                char = buf.peek()
+                if char == "]":
+                    buf.pos += 1
+                    break
+                if char == ",":
+                    buf.pos += 1
+                    continue
+                if not char:
+                    raise ValueError("JSON stream ended inside an array")
+                yield key, buf.value()
+        else:
+            yield key, buf.value()
@@ -0,0 +1,102 @@
+import queue, threading
+
+_DONE = object()
+
+
+class _Failed:
+    def __init__(self, exc):
+        self.exc = exc
+
+
+def prefetch(pages, depth):
+    """
+    Iterate `pages` (an iterator that downloads one page per step) on a background
+    thread, so page N+1 is being fetched while the caller works on page N.
+
+    At most `depth` downloaded pages wait in the queue, which bounds memory. Errors
+    raised while fetching are re-raised in the caller. If the caller stops early, the
+    fetcher is told to stop too. depth <= 0 means plain, in-line iteration.
+    """
+    if depth <= 0:
+        yield from pages
+        return
+
+    q = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run():
+        try:
+            for page in pages:
+                if not put(page):
+                    return
+            put(_DONE)
+        except BaseException as e:
+            put(_Failed(e))
+
+    t = threading.Thread(target=run, daemon=True, name="directory-sync-prefetch")
+    t.start()
+    try:
+        while True:
+            item = q.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Failed):
+                raise item.exc
+            yield item
+    finally:
+        stop.set()
+
+
+def merge(sources, depth):
+    """
+    Iterate several page iterators at once, each on its own background thread, and
+    yield (index, page) in the order pages arrive. Pages of one source keep their order.
+
+    Same contract as prefetch(): at most `depth` pages per source wait in the queue, the
+    first error raised by any source is re-raised in the caller (the others are stopped),
+    and stopping early stops every fetcher.
+    """
+    q = queue.Queue(maxsize=max(1, depth) * max(1, len(sources)))
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run(index, pages):
+        try:
+            for page in pages:
+                if not put((index, page)):
+                    return
+            put(_DONE)
+        except BaseException as e:
+            put(_Failed(e))
+
+    for index, pages in enumerate(sources):
+        threading.Thread(target=run, args=(index, pages), daemon=True, name=f"directory-sync-segment-{index}").start()
+    try:
+        running = len(sources)
+        while running:
+            item = q.get()
+            if item is _DONE:
+                running -= 1
+                continue
+            if isinstance(item, _Failed):
+                raise item.exc
+            yield item
+    finally:
+        stop.set()
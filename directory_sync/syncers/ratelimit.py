@@ -0,0 +1,75 @@
+import random, threading, time
+from django.conf import settings
+
+THROTTLE_STATUSES = {429, 503, 504}
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every call to one API tenant in this process (all runs, all
+    worker threads). The rate adapts: each throttled response halves it and blocks
+    everybody until the server's Retry-After has passed; successes win it back slowly.
+    """
+
+    def __init__(self, rate, burst, min_rate=1.0):
+        self.max_rate = float(rate)
+        self.min_rate = min(float(min_rate), self.max_rate)
+        self.rate = self.max_rate
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a call may go out; returns the seconds spent waiting."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def throttled(self, delay):
+        """The server pushed back (429/503/504): slow down and hold all callers for `delay` seconds."""
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+
+    def succeeded(self):
+        with self._lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * 0.01)
+
+
+def backoff_seconds(retry_after, attempt, base=1.0, cap=60.0):
+    """Retry-After (seconds form) plus a little jitter, else full-jitter exponential backoff."""
+    try:
+        return float(retry_after) + random.uniform(0, 1)
+    except (TypeError, ValueError):
+        return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def get_limiter(key):
+    """Process-wide limiter per tenant (DIRECTORY_SYNC_RATE_PER_SECOND / DIRECTORY_SYNC_RATE_BURST)."""
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = RateLimiter(
+                rate=getattr(settings, "DIRECTORY_SYNC_RATE_PER_SECOND", 25),
+                burst=getattr(settings, "DIRECTORY_SYNC_RATE_BURST", 50),
+            )
+            _limiters[key] = limiter
+        return limiter
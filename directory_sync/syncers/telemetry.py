@@ -0,0 +1,86 @@
+import threading, time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class RunMetrics:
+    """
+    Structured numbers for one sync run, stored on SyncJob (scalar columns for trends,
+    the full breakdown in SyncJob.metrics).
+
+    - phase(name): wall time of a block; repeated blocks add up ("setup", "groups", ...)
+    - lap(name): time since the previous lap() booked to `name`, for the steps of a page loop
+    - timed(pages, name): an iterator whose waiting time is booked to `name`
+      (with prefetch: how long the writer sat idle waiting for Graph)
+    - db: connection.execute_wrapper hook, counts the statements of the sync thread and their time
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.phases = defaultdict(float)
+        self.pages = 0
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.extra = {}  # syncer-specific counters, copied into the metrics as-is
+        self._lap_started = None
+
+    @contextmanager
+    def phase(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phases[name] += time.perf_counter() - t0
+
+    def lap(self, name=None):
+        """Books the time since the previous lap() to `name`; lap() without a name only restarts the clock."""
+        now = time.perf_counter()
+        if name and self._lap_started is not None:
+            with self._lock:
+                self.phases[name] += now - self._lap_started
+        self._lap_started = now
+
+    def timed(self, iterable, name):
+        it = iter(iterable)
+        while True:
+            t0 = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            finally:
+                with self._lock:
+                    self.phases[name] += time.perf_counter() - t0
+            yield item
+
+    def db(self, execute, sql, params, many, context):
+        t0 = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            with self._lock:
+                self.db_queries += 1
+                self.db_seconds += time.perf_counter() - t0
+
+    def as_dict(self, http_stats=None, throttle_wait=0.0):
+        """JSON-ready snapshot; the keys match the SyncJob columns mark() fills from it."""
+        d = {
+            "wall_seconds": round(time.perf_counter() - self.started, 3),
+            "pages": self.pages,
+            "db_queries": self.db_queries,
+            "db_seconds": round(self.db_seconds, 3),
+            "throttle_wait_seconds": round(throttle_wait, 3),
+            "phases": {k: round(v, 3) for k, v in self.phases.items()},
+        }
+        if http_stats is not None:
+            d.update({
+                "http_calls": http_stats.calls,
+                "http_bytes": http_stats.bytes,
+                "http_p50_ms": round(http_stats.percentile(50), 1),
+                "http_p95_ms": round(http_stats.percentile(95), 1),
+                "http_by_endpoint": dict(http_stats.by_endpoint.most_common()),
+            })
+        d.update(self.extra)
+        return d
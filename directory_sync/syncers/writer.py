@@ -0,0 +1,178 @@
+from collections import Counter
+from django.db import transaction
+from django.db.models import Q
+from accounts.models import User
+
+# User columns a directory sync owns; bulk_update writes exactly these
+SYNCED_FIELDS = [
+    "email", "email_domain", "identity_source", "is_active", "azure_oid", "tenant_id",
+    "first_name", "last_name", "job_title", "department",
+    "manager_email", "licenses", "groups_cache", "directory_fingerprint",
+]
+# written with the rest, but a row whose only difference it is counts as unchanged
+BOOKKEEPING_FIELDS = {"directory_fingerprint"}
+
+
+class PageWriter:
+    """
+    Upserts one page of directory users with one read and at most two writes.
+
+    load() fetches every existing row for the page's emails and external ids in one query,
+    get() hands out the row for a user (a new, unsaved one with an unusable password if
+    there is none), and save() bulk-creates the new rows and bulk-updates the rest inside
+    one transaction. Updates write only the columns that differ from the loaded row and
+    leave identical rows alone; `unchanged` holds them, plus the rows where only a
+    BOOKKEEPING_FIELDS column was written. `field_changes` counts updated rows per column.
+    """
+
+    def __init__(self, identity_source, oid_field=None, fields=SYNCED_FIELDS):
+        self.identity_source = identity_source
+        self.oid_field = oid_field
+        self.fields = fields
+        self.by_email = {}
+        self.by_oid = {}
+        self.original = {}  # pk -> synced field values as loaded
+        self.unchanged = set()  # pks of loaded rows save() found identical and did not write
+        self.field_changes = Counter()
+
+    def load(self, keys):
+        """keys: iterable of (email, external id or None) for the page."""
+        keys = list(keys)
+        emails = {e for e, _ in keys if e}
+        oids = {o for _, o in keys if o}
+        q = Q(email__in=emails)
+        if self.oid_field and oids:
+            q |= Q(identity_source=self.identity_source, **{f"{self.oid_field}__in": oids})
+
+        self.by_email, self.by_oid, self.original = {}, {}, {}
+        for obj in User.objects.filter(q):
+            self.by_email[obj.email] = obj
+            self.original[obj.pk] = {f: getattr(obj, f) for f in self.fields}
+            oid = getattr(obj, self.oid_field) if self.oid_field else None
+            if oid and obj.identity_source == self.identity_source:
+                self.by_oid[oid] = obj
+
+    def get(self, email, oid=None, is_active=True):
+        """
+        Returns (obj, is_created). A user renamed in the directory is matched by its
+        external id and gets the new email. Asking twice for the same user returns the
+        same instance, so a duplicate on one page is written once.
+        """
+        obj = self.by_email.get(email) or (self.by_oid.get(oid) if oid else None)
+        if obj is not None:
+            if obj.email != email:
+                self.by_email.pop(obj.email, None)
+                obj.email = email
+                self.by_email[email] = obj
+            return obj, False
+
+        obj = User(email=email, identity_source=self.identity_source, is_active=is_active)
+        obj.set_unusable_password()  # password auth must never work for directory accounts
+        self.by_email[email] = obj
+        if oid:
+            self.by_oid[oid] = obj
+        return obj, True
+
+    def changes(self, obj):
+        """
+        {field: (old, new)} for the synced fields that differ from the loaded row
+        (normalized the way save() would store them). A new row lists its non-empty fields.
+        """
+        obj._normalize_fields()
+        before = self.original.get(obj.pk, {}) if obj.pk else {}
+        out = {}
+        for f in self.fields:
+            new = getattr(obj, f)
+            old = before.get(f)
+            if new != old and not (obj.pk is None and new in (None, "", [])):
+                out[f] = (old, new)
+        return out
+
+    def save(self, objs):
+        """
+        Writes the given rows in one transaction; raises on any DB error (nothing is written
+        then, and the new rows are unsaved again, ready for save_one).
+        Changed rows are grouped by the set of columns they change, one bulk_update per group.
+        """
+        seen, new, by_fields = set(), [], {}
+        field_changes, unchanged = Counter(), set()
+        for obj in objs:
+            if id(obj) in seen:
+                continue
+            seen.add(id(obj))
+            if not obj.pk:
+                obj._normalize_fields()  # bulk_* bypass User.save(), so apply its rules here
+                new.append(obj)
+                continue
+            fields = tuple(self.changes(obj))  # normalizes too
+            changed = [f for f in fields if f not in BOOKKEEPING_FIELDS]
+            if not changed:
+                unchanged.add(obj.pk)
+            field_changes.update(changed)
+            if fields:
+                by_fields.setdefault(fields, []).append(obj)
+
+        try:
+            with transaction.atomic():
+                if new:
+                    User.objects.bulk_create(new, batch_size=500)
+                for fields, rows in by_fields.items():
+                    User.objects.bulk_update(rows, fields, batch_size=500)
+        except Exception:
+            # rolled back: rows bulk_create gave a pk are not in the table, so save_one must insert them
+            for obj in new:
+                obj.pk = None
+                obj._state.adding = True
+            raise
+        self.field_changes.update(field_changes)
+        self.unchanged |= unchanged
+
+    def save_one(self, obj):
+        """Row-by-row fallback of save(): a plain save() for a new row, only the changed columns otherwise."""
+        if not obj.pk:
+            obj.save()
+            return
+        fields = list(self.changes(obj))
+        changed = [f for f in fields if f not in BOOKKEEPING_FIELDS]
+        if not changed:
+            self.unchanged.add(obj.pk)
+        if fields:
+            obj.save(update_fields=fields)
+        self.field_changes.update(changed)
+
+
+def unseen_users(active, key_field, seen, max_percent):
+    """
+    Set difference after a complete full crawl: rows of `active` (the directory's active
+    synced users) whose `key_field` value was not listed, as (pk, email, key) tuples.
+    The note is set when they are more than max_percent of `active`; then nobody may be
+    deactivated (a truncated or mis-scoped crawl must not wipe out the directory).
+    """
+    local = list(active.values_list("pk", "email", key_field))
+    missing = [row for row in local if row[2] not in seen]
+    if not missing:
+        return [], ""
+    percent = 100 * len(missing) / len(local)
+    if percent > max_percent:
+        return missing, (
+            f"deprovisioning aborted: {len(missing)} of {len(local)} active users ({percent:.1f}%) "
+            f"were not seen in the full crawl, more than the {max_percent}% limit"
+        )
+    return missing, ""
+
+
+def deactivate(pks):
+    """Sets is_active=False on these users in one transaction; returns how many rows flipped."""
+    n = 0
+    with transaction.atomic():
+        # pk chunks keep the statement under the database's parameter limit
+        for i in range(0, len(pks), 500):
+            n += User.objects.filter(pk__in=pks[i:i + 500], is_active=True).update(is_active=False)
+    return n
+
+
+def field_changes_note(counts):
+    """Job note for PageWriter.field_changes, most changed column first; "" when nothing was updated."""
+    if not counts:
+        return ""
+    return "updated columns: " + ", ".join(f"{f}={n}" for f, n in counts.most_common())
@@ -1,3 +1,431 @@
-from django.test import TestCase
+import json
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
+import requests
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from accounts.models import User
+from .fakegraph import FakeGraph
+from .models import ExternalDirectory, SchedulerLeader, SyncJob
+from .scheduler import (
+    Leadership, _max_concurrent, claim, due_directories, fail_orphaned_jobs, no_in_process_scheduler, release, renew,
+)
+from .syncers.azure import DELTA_SELECT, AzureSyncer
+from .syncers.http import CallStats, build_session, request_repeatable
+from .syncers.jsonstream import iter_object
+from .syncers.writer import PageWriter
 
-# Create your tests here.
+# the tests below drive leases and elections themselves: no scheduler thread in this process
+no_in_process_scheduler()
+
+
+def _chunks(raw, size):
+    return [raw[i:i + size] for i in range(0, len(raw), size)]
+
+
+class _StreamedResponse:
+    """The part of requests.Response that AzureSyncer._streamed_page reads."""
+
+    status_code = 200
+
+    def __init__(self, body):
+        self.raw = json.dumps(body).encode()
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        return iter(_chunks(self.raw, 11))  # small chunks: tokens get split between them
+
+    def close(self):
+        pass
+
+
+def _graph_page(users, next_link=None, delta_link=None):
+    """A users page with its members in Graph's order: context, links, then "value"."""
+    body = {"@odata.context": "https://graph.example/v1.0/$metadata#users"}
+    if next_link:
+        body["@odata.nextLink"] = next_link
+    if delta_link:
+        body["@odata.deltaLink"] = delta_link
+    body["value"] = users
+    return body
+
+
+class TransportRetryTests(SimpleTestCase):
+    def test_only_gets_are_repeated_by_the_session(self):
+        retry = build_session().get_adapter("https://graph.example").max_retries
+        self.assertTrue(retry.is_retry("GET", 502))
+        self.assertFalse(retry.is_retry("POST", 502))
+        self.assertFalse(retry.is_retry("PATCH", 500))
+
+    @mock.patch("directory_sync.syncers.http.time.sleep")
+    def test_read_only_post_is_repeated(self, sleep):
+        session = mock.Mock()
+        session.request.side_effect = [
+            requests.ConnectionError("reset"), SimpleNamespace(status_code=502, close=lambda: None),
+            SimpleNamespace(status_code=200),
+        ]
+        r = request_repeatable(session, "POST", "https://graph.example/v1.0/$batch", json={})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(session.request.call_count, 3)
+
+
+class IterObjectTests(SimpleTestCase):
+    def test_links_before_value(self):
+        body = _graph_page([{"id": str(i), "mail": f"ü{i}@x.edu"} for i in range(3)], next_link="https://next")
+        out = list(iter_object(_chunks(json.dumps(body, ensure_ascii=False).encode(), 5)))
+        self.assertEqual(out, [
+            ("@odata.context", "https://graph.example/v1.0/$metadata#users"),
+            ("@odata.nextLink", "https://next"),
+            ("value", {"id": "0", "mail": "ü0@x.edu"}),
+            ("value", {"id": "1", "mail": "ü1@x.edu"}),
+            ("value", {"id": "2", "mail": "ü2@x.edu"}),
+        ])
+
+    def test_numbers_split_across_chunks_and_empty_array(self):
+        raw = b'{"value": [], "n": 12345, "x": [1, 2]}'
+        self.assertEqual(list(iter_object(_chunks(raw, 3))), [("n", 12345), ("x", [1, 2])])
+
+    def test_truncated_stream(self):
+        with self.assertRaises(ValueError):
+            list(iter_object([b'{"value": [{"id": 1}, ']))
+
+
+@override_settings(DIRECTORY_SYNC_STREAM_PAGES=True)
+class StreamedPagesTests(SimpleTestCase):
+    def setUp(self):
+        directory = ExternalDirectory(provider="azure", credentials={"tenant_id": "t"})
+        self.syncer = AzureSyncer(directory)
+        self.syncer.http = SimpleNamespace(stats=CallStats())
+        users = [{"id": f"u{i}"} for i in range(7)]
+        self.bodies = {
+            "https://graph/users/delta": _graph_page(users[:5], next_link="https://graph/page2"),
+            "https://graph/page2": _graph_page(users[5:], delta_link="https://graph/delta?token=1"),
+        }
+        self.syncer._request = lambda method, url, **kwargs: _StreamedResponse(self.bodies[url])
+
+    def test_links_only_on_the_last_piece(self):
+        with mock.patch("directory_sync.syncers.azure.STREAM_CHUNK_USERS", 2):
+            pieces = list(self.syncer._pages("https://graph/users/delta"))
+        self.assertEqual([len(p["value"]) for p in pieces], [2, 2, 1, 2, 0])
+        self.assertEqual([p.get("@odata.nextLink") for p in pieces], [None, None, "https://graph/page2", None, None])
+        self.assertEqual(pieces[-1]["@odata.deltaLink"], "https://graph/delta?token=1")
+        self.assertEqual([u["id"] for p in pieces for u in p["value"]], [f"u{i}" for i in range(7)])
+
+
+class BatchTests(SimpleTestCase):
+    def setUp(self):
+        directory = ExternalDirectory(provider="azure", credentials={"tenant_id": "t"}, batch_requests=True)
+        self.syncer = AzureSyncer(directory)
+        self.syncer.limiter = mock.Mock()
+        self.envelopes = []
+
+    def _answer(self, *rounds):
+        """_post answering each envelope with the next round's {id: status}."""
+        rounds = list(rounds)
+
+        def post(url, json=None, repeatable=False):
+            self.envelopes.append([item["id"] for item in json["requests"]])
+            statuses = rounds.pop(0)
+            return {"responses": [
+                {"id": item["id"], "status": statuses[item["id"]], "headers": {"Retry-After": "2"},
+                 "body": {"mail": f"M{item['id']}@X.edu"} if statuses[item["id"]] == 200 else {}}
+                for item in json["requests"]
+            ]}
+        self.syncer._post = post
+
+    def test_throttled_items_are_sent_again(self):
+        self._answer({"0": 200, "1": 429, "2": 404}, {"1": 200})
+        found = self.syncer._manager_emails(["a", "b", "c"])
+        self.assertEqual(found, {"a": "m0@x.edu", "b": "m1@x.edu", "c": None})  # 404: no such manager
+        self.assertEqual(self.envelopes, [["0", "1", "2"], ["1"]])
+        self.syncer.limiter.throttled.assert_called_once()
+
+    def test_other_errors_fail_the_lookup(self):
+        self._answer({"0": 200, "1": 500})
+        with self.assertRaises(requests.HTTPError):
+            self.syncer._manager_emails(["a", "b"])
+
+
+class FakeGraphSyncTests(TestCase):
+    """Whole AzureSyncer runs against a local FakeGraph."""
+
+    def setUp(self):
+        self.fake = FakeGraph(users=40).start()
+        self.addCleanup(self.fake.stop)
+        self.d = ExternalDirectory.objects.create(
+            name="fake", provider="azure", is_enabled=False, credentials=self.fake.credentials(),
+            include_groups=False, include_licenses=False, expand_full_crawl=False, deprovision_missing=True,
+        )
+
+    def _sync(self):
+        self.d.refresh_from_db()
+        return AzureSyncer(self.d).sync()
+
+    def _active(self):
+        return User.objects.filter(identity_source="AZURE", is_active=True).count()
+
+    def _vanish(self, n):
+        """n users deleted in Graph while we had no cursor: no @removed will ever come."""
+        for u in self.fake.users[:n]:
+            u["_deleted"] = True
+        ExternalDirectory.objects.filter(pk=self.d.pk).update(delta_link="")
+
+    def test_full_crawl_missing_too_many_deactivates_nothing(self):
+        self._sync()
+        active = self._active()  # every 20th fake user is disabled
+        self._vanish(8)  # over the default 10% limit
+        result = self._sync()
+        self.assertEqual(result["deactivated"], 0)
+        self.assertEqual(self._active(), active)
+        self.assertIn(f"deprovisioning aborted: 8 of {active} active users", result["notes"])
+
+    def test_full_crawl_deactivates_missing_users_under_the_limit(self):
+        ExternalDirectory.objects.filter(pk=self.d.pk).update(deprovision_max_percent=25)
+        self._sync()
+        active = self._active()
+        self._vanish(8)
+        result = self._sync()
+        self.assertEqual(result["deactivated"], 8)
+        self.assertEqual(self._active(), active - 8)
+
+    def test_resume_from_checkpoint(self):
+        link = f"{self.fake.base_url}/v1.0/users/delta?$select={DELTA_SELECT}&$top=15&$skiptoken=15"
+        ExternalDirectory.objects.filter(pk=self.d.pk).update(
+            crawl_checkpoint={"next_link": link, "page": 1, "full": True},
+        )
+        result = self._sync()
+        self.assertEqual(result["created"], 25)  # the 15 users before the checkpoint were written by the crashed run
+        self.assertIn("resumed from checkpoint at page 2", result["notes"])
+        self.assertIn("missing users not deprovisioned this time", result["notes"])
+        self.d.refresh_from_db()
+        self.assertEqual(self.d.crawl_checkpoint, {})
+        self.assertIn("deltatoken=", self.d.delta_link)
+
+    def test_rejected_checkpoint_starts_over(self):
+        ExternalDirectory.objects.filter(pk=self.d.pk).update(
+            crawl_checkpoint={"next_link": f"{self.fake.base_url}/v1.0/users/gone/stale", "page": 3, "full": True},
+        )
+        with self.assertRaises(requests.HTTPError):
+            self._sync()
+        self.d.refresh_from_db()
+        self.assertEqual(self.d.crawl_checkpoint, {})
+        self.assertEqual(self._sync()["created"], 40)
+
+    def test_groups_delta_inverts_memberships(self):
+        ExternalDirectory.objects.filter(pk=self.d.pk).update(include_groups=True, group_sync_mode="delta")
+        self._sync()
+        self.fake.mutate(added=2, regrouped=3)
+        self.assertIn("groups delta: 5 users' groups changed", self._sync()["notes"])
+        for u in self.fake.users:
+            self.assertEqual(User.objects.get(azure_oid=u["id"]).groups_cache, sorted(u["_groups"]))
+
+
+class PageWriterTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(
+            email="amira@x.edu", identity_source="AZURE", azure_oid="oid-a", job_title="Teacher", department="IT",
+        )
+
+    def _updates(self, queries):
+        return [q["sql"] for q in queries if q["sql"].startswith("UPDATE")]
+
+    def test_updates_only_changed_columns(self):
+        writer = PageWriter("AZURE", oid_field="azure_oid")
+        writer.load([("amira@x.edu", "oid-a"), ("bilal@x.edu", "oid-b")])
+        amira, created = writer.get("amira@x.edu", "oid-a")
+        self.assertFalse(created)
+        amira.job_title = " Principal "
+        bilal, created = writer.get("bilal@x.edu", "oid-b")
+        self.assertTrue(created)
+        with CaptureQueriesContext(connection) as q:
+            writer.save([amira, bilal])
+        updates = self._updates(q.captured_queries)
+        self.assertEqual(len(updates), 1)
+        self.assertIn('"job_title"', updates[0])
+        self.assertNotIn('"department"', updates[0])
+        self.assertEqual(writer.field_changes, {"job_title": 1})
+        self.assertEqual(User.objects.get(pk=self.user.pk).job_title, "Principal")
+        self.assertEqual(User.objects.get(email="bilal@x.edu").email_domain, "x.edu")
+
+    def test_identical_row_is_not_written(self):
+        writer = PageWriter("AZURE", oid_field="azure_oid")
+        writer.load([("amira@x.edu", "oid-a")])
+        amira, _ = writer.get("amira@x.edu", "oid-a")
+        amira.department = "IT "  # normalized to the stored value
+        with CaptureQueriesContext(connection) as q:
+            writer.save([amira])
+        self.assertEqual(self._updates(q.captured_queries), [])
+        self.assertEqual(writer.unchanged, {self.user.pk})
+        self.assertFalse(writer.field_changes)
+
+    def test_fingerprint_only_row_counts_as_unchanged(self):
+        writer = PageWriter("AZURE", oid_field="azure_oid")
+        writer.load([("amira@x.edu", "oid-a")])
+        amira, _ = writer.get("amira@x.edu", "oid-a")
+        amira.directory_fingerprint = "new-hash"
+        writer.save([amira])
+        self.assertEqual(writer.unchanged, {self.user.pk})
+        self.assertFalse(writer.field_changes)
+        self.assertEqual(User.objects.get(pk=self.user.pk).directory_fingerprint, "new-hash")
+
+    def test_renamed_user_is_matched_by_external_id(self):
+        writer = PageWriter("AZURE", oid_field="azure_oid")
+        writer.load([("amira.new@y.edu", "oid-a")])
+        amira, created = writer.get("amira.new@y.edu", "oid-a")
+        self.assertFalse(created)
+        self.assertEqual(amira.pk, self.user.pk)
+        writer.save([amira, amira])  # listed twice on one page: written once
+        self.assertEqual(writer.field_changes, {"email": 1, "email_domain": 1})
+        self.assertEqual(User.objects.get(pk=self.user.pk).email, "amira.new@y.edu")
+
+    def test_rows_can_be_saved_one_by_one_after_a_failed_page(self):
+        writer = PageWriter("AZURE", oid_field="azure_oid")
+        writer.load([("amira@x.edu", "oid-a"), ("bilal@x.edu", "oid-b")])
+        amira, _ = writer.get("amira@x.edu", "oid-a")
+        amira.job_title = "Principal"
+        bilal, _ = writer.get("bilal@x.edu", "oid-b")
+        with mock.patch.object(User.objects, "bulk_update", side_effect=RuntimeError("page failed")):
+            with self.assertRaises(RuntimeError):
+                writer.save([amira, bilal])
+        self.assertIsNone(bilal.pk)  # the bulk_create was rolled back with the rest
+        for obj in (amira, bilal):
+            writer.save_one(obj)
+        self.assertTrue(User.objects.filter(email="bilal@x.edu").exists())
+        self.assertEqual(User.objects.get(pk=self.user.pk).job_title, "Principal")
+
+
+class LeaseTests(TestCase):
+    def setUp(self):
+        self.d = ExternalDirectory.objects.create(name="t", provider="azure", is_enabled=True)
+
+    def test_one_claim_wins(self):
+        self.assertTrue(claim(self.d, "a"))
+        self.assertFalse(claim(ExternalDirectory.objects.get(pk=self.d.pk), "b"))
+        self.assertEqual(list(due_directories(timezone.now())), [])
+        self.assertEqual(renew([self.d.pk], "b"), 0)
+        self.assertEqual(renew([self.d.pk], "a"), 1)
+
+    def test_expired_lease_can_be_claimed(self):
+        ExternalDirectory.objects.filter(pk=self.d.pk).update(
+            lease_owner="dead", lease_expires_at=timezone.now() - timedelta(seconds=1),
+        )
+        self.assertTrue(claim(self.d, "b"))
+        self.assertEqual(ExternalDirectory.objects.get(pk=self.d.pk).lease_owner, "b")
+
+    def test_release_only_by_holder(self):
+        claim(self.d, "a")
+        release(self.d, "b")
+        self.assertEqual(ExternalDirectory.objects.get(pk=self.d.pk).lease_owner, "a")
+        release(self.d, "a")
+        self.assertIsNone(ExternalDirectory.objects.get(pk=self.d.pk).lease_expires_at)
+
+    def test_no_claim_once_the_run_moved_next_run_at(self):
+        stale = ExternalDirectory.objects.get(pk=self.d.pk)  # a due list read before the run
+        ExternalDirectory.objects.filter(pk=self.d.pk).update(
+            next_run_at=timezone.now() + timedelta(hours=1), delta_link="https://graph/delta?token=2",
+        )
+        self.assertFalse(claim(stale, "b"))
+        self.assertEqual(stale.delta_link, "")
+
+    def test_claim_reloads_the_directory(self):
+        stale = ExternalDirectory.objects.get(pk=self.d.pk)
+        ExternalDirectory.objects.filter(pk=self.d.pk).update(delta_link="https://graph/delta?token=2")
+        self.assertTrue(claim(stale, "a"))
+        self.assertEqual(stale.delta_link, "https://graph/delta?token=2")
+
+    def test_disabled_directory_is_not_claimed(self):
+        ExternalDirectory.objects.filter(pk=self.d.pk).update(is_enabled=False)
+        self.assertFalse(claim(self.d, "a"))
+
+    def test_orphaned_jobs_fail(self):
+        job = SyncJob.objects.create(directory=self.d, status="running")
+        fail_orphaned_jobs(self.d)
+        self.assertEqual(SyncJob.objects.get(pk=job.pk).status, "failed")
+
+
+class DispatcherTests(SimpleTestCase):
+    def test_one_run_at_a_time_on_sqlite(self):
+        self.assertEqual(_max_concurrent(), 1)  # the test database is SQLite
+        with override_settings(DIRECTORY_SYNC_MAX_CONCURRENT=3):
+            self.assertEqual(_max_concurrent(), 3)
+
+
+class LeadershipTests(TestCase):
+    def setUp(self):
+        self.a = Leadership(name="test", owner="a")
+        self.b = Leadership(name="test", owner="b")
+
+    def test_one_leader_at_a_time(self):
+        self.assertTrue(self.a.heartbeat())
+        self.assertFalse(self.b.heartbeat())
+        self.assertTrue(self.a.heartbeat())  # keeps it
+        self.assertEqual(SchedulerLeader.objects.get(name="test").owner, "a")
+
+    def test_standby_takes_over_when_the_leader_lapses(self):
+        self.a.heartbeat()
+        SchedulerLeader.objects.filter(name="test").update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertTrue(self.b.heartbeat())
+        with self.assertLogs("directory_sync.scheduler", "WARNING") as logs:
+            self.assertFalse(self.a.heartbeat())
+        self.assertIn("a is no longer the scheduler leader", logs.output[0])
+
+    def test_resign_hands_over_at_once(self):
+        self.a.heartbeat()
+        self.b.resign()  # not the leader: changes nothing
+        self.assertFalse(self.b.heartbeat())
+        self.a.resign()
+        self.assertTrue(self.b.heartbeat())
+
+
+@override_settings(DIRECTORY_SYNC_NOTIFY_DEBOUNCE_SECONDS=20)
+class GraphNotificationTests(TestCase):
+    def setUp(self):
+        self.url = reverse("directory_sync:graph_notifications")
+        self.later = timezone.now() + timedelta(hours=1)
+        self.d = ExternalDirectory.objects.create(
+            name="t", provider="azure", is_enabled=True, next_run_at=self.later,
+            notification_client_state="s3cret", graph_subscriptions=[{"id": "sub-1", "resource": "users"}],
+        )
+
+    def _notify(self, client_state, subscription_id="sub-1"):
+        body = {"value": [{"subscriptionId": subscription_id, "clientState": client_state, "changeType": "updated"}]}
+        return self.client.post(self.url, data=json.dumps(body), content_type="application/json")
+
+    def _next_run_at(self):
+        return ExternalDirectory.objects.get(pk=self.d.pk).next_run_at
+
+    def test_validation_token_is_echoed(self):
+        r = self.client.post(f"{self.url}?validationToken=abc%20123")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r["Content-Type"], "text/plain")
+        self.assertEqual(r.content, b"abc 123")
+
+    def test_wrong_client_state_is_ignored(self):
+        r = self._notify("guess")
+        self.assertEqual(r.status_code, 202)
+        self.assertEqual(self._next_run_at(), self.later)
+
+    def test_unknown_subscription_is_ignored(self):
+        self.assertEqual(self._notify("s3cret", subscription_id="sub-2").status_code, 202)
+        self.assertEqual(self._next_run_at(), self.later)
+
+    def test_valid_notification_brings_the_run_forward_once(self):
+        before = timezone.now()
+        self.assertEqual(self._notify("s3cret").status_code, 202)
+        planned = self._next_run_at()
+        self.assertLess(planned, self.later)
+        self.assertGreaterEqual(planned, before + timedelta(seconds=20))
+        self._notify("s3cret")  # the burst coalesces into the run already planned
+        self.assertEqual(self._next_run_at(), planned)
+
+    def test_malformed_body_is_rejected(self):
+        for raw in (b"{not json", b"[1, 2]"):
+            r = self.client.post(self.url, data=raw, content_type="application/json")
+            self.assertEqual(r.status_code, 400)
+        self.assertEqual(self.client.get(self.url).status_code, 405)
@@ -0,0 +1,170 @@
+import json, threading, time
+import jwt
+import requests
+from django.conf import settings
+from msal import ConfidentialClientApplication, SerializableTokenCache
+from requests.auth import AuthBase
+
+GRAPH_SCOPE = ["https://graph.microsoft.com/.default"]
+AUTHORITY_HOST = "https://login.microsoftonline.com"
+GOOGLE_TOKEN_URI = "https://oauth2.googleapis.com/token"
+GOOGLE_SCOPES = [
+    "https://www.googleapis.com/auth/admin.directory.user.readonly",
+    "https://www.googleapis.com/auth/admin.directory.group.readonly",
+]
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+class AzureTokenProvider:
+    """
+    App-only Graph token for one ExternalDirectory.
+
+    The MSAL app (and its authority metadata) is built once per process and reused by
+    every caller: the scheduler thread, the admin "Test connection" action and
+    run_directory_scheduler. Its token cache is persisted on the directory row (persist()),
+    so a restart picks up a still-valid token instead of asking Entra ID for a new one.
+    token() refreshes shortly before expiry, so a crawl that outlives one token keeps going.
+    """
+
+    def __init__(self, directory):
+        c = directory.credentials or {}
+        self.directory_id = directory.pk
+        self.cache = SerializableTokenCache()
+        if getattr(directory, "token_cache", ""):
+            try:
+                self.cache.deserialize(directory.token_cache)
+            except ValueError:
+                pass  # corrupt/old format: start empty, it gets overwritten on the next save
+        # authority_host: national clouds or a local stand-in (see directory_sync.fakegraph)
+        authority_host = (c.get("authority_host") or AUTHORITY_HOST).rstrip("/")
+        http_client = None
+        if c.get("ca_bundle"):
+            # MSAL's own session would let REQUESTS_CA_BUNDLE in the environment override `verify`
+            http_client = requests.Session()
+            http_client.verify = c["ca_bundle"]
+            http_client.trust_env = False
+        self.app = ConfidentialClientApplication(
+            client_id=c.get("client_id"),
+            client_credential=c.get("client_secret"),
+            authority=f"{authority_host}/{c.get('tenant_id')}",
+            token_cache=self.cache,
+            instance_discovery=None if authority_host == AUTHORITY_HOST else False,
+            verify=c.get("ca_bundle") or True,
+            http_client=http_client,
+        )
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0.0
+
+    def token(self):
+        # MSAL itself treats tokens within 5 minutes of expiry as expired, so a margin up
+        # to 300s always yields a fresh token from acquire_token_for_client.
+        margin = getattr(settings, "DIRECTORY_SYNC_TOKEN_REFRESH_SECONDS", 300)
+        with self._lock:
+            if self._token and time.time() < self._expires_at - margin:
+                return self._token
+            result = self.app.acquire_token_for_client(scopes=GRAPH_SCOPE)
+            if "access_token" not in result:
+                raise RuntimeError(f"Azure token error: {result}")
+            self._token = result["access_token"]
+            self._expires_at = time.time() + int(result.get("expires_in", 3600))
+            return self._token
+
+    def persist(self):
+        """
+        Saves the token cache on the directory row if it changed. token() runs on whatever
+        thread sends a request (enrichment workers, page fetchers), so it never writes;
+        the syncer calls this on its own thread when it opens and closes its session.
+        """
+        if not self.directory_id:
+            return
+        from .models import ExternalDirectory
+        with self._lock:
+            if not self.cache.has_state_changed:
+                return
+            state = self.cache.serialize()
+            self.cache.has_state_changed = False
+        # queryset update: never clobbers other fields of a directory row another thread holds
+        ExternalDirectory.objects.filter(pk=self.directory_id).update(token_cache=state)
+
+
+class GoogleTokenProvider:
+    """
+    Admin SDK token for one Google Workspace directory: a service account with
+    domain-wide delegation, acting as the admin in credentials["subject"].
+
+    Signs a JWT with the service account key (RS256) and trades it for an access token
+    (OAuth 2.0 JWT bearer grant). Tokens live about an hour and are kept in memory only;
+    token() renews them DIRECTORY_SYNC_TOKEN_REFRESH_SECONDS before expiry.
+    """
+
+    def __init__(self, directory):
+        c = directory.credentials or {}
+        key = c.get("service_account") or {}
+        if isinstance(key, str):
+            key = json.loads(key)  # the downloaded key file pasted as a string
+        self.client_email = key.get("client_email")
+        self.private_key = key.get("private_key")
+        self.subject = c.get("subject")
+        # token_uri: from the key file unless overridden (local stand-in, see directory_sync.fakegoogle)
+        self.token_uri = c.get("token_uri") or key.get("token_uri") or GOOGLE_TOKEN_URI
+        self.verify = c.get("ca_bundle") or True
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0.0
+
+    def token(self):
+        margin = getattr(settings, "DIRECTORY_SYNC_TOKEN_REFRESH_SECONDS", 300)
+        with self._lock:
+            if self._token and time.time() < self._expires_at - margin:
+                return self._token
+            now = int(time.time())
+            assertion = jwt.encode({
+                "iss": self.client_email,
+                "sub": self.subject,
+                "scope": " ".join(GOOGLE_SCOPES),
+                "aud": self.token_uri,
+                "iat": now,
+                "exp": now + 3600,
+            }, self.private_key, algorithm="RS256")
+            with requests.Session() as s:
+                s.trust_env = self.verify is True  # an explicit CA bundle wins over REQUESTS_CA_BUNDLE
+                r = s.post(self.token_uri, data={
+                    "grant_type": "urn:ietf:params:oauth:grant-type:jwt-bearer",
+                    "assertion": assertion,
+                }, verify=self.verify, timeout=30)
+            result = r.json() if r.content else {}
+            if "access_token" not in result:
+                raise RuntimeError(f"Google token error: {r.status_code} {result}")
+            self._token = result["access_token"]
+            self._expires_at = time.time() + int(result.get("expires_in", 3600))
+            return self._token
+
+    def persist(self):
+        pass  # tokens are kept in memory only
+
+
+class BearerAuth(AuthBase):
+    """requests auth hook: asks the provider for a (possibly refreshed) token on every call."""
+
+    def __init__(self, provider):
+        self.provider = provider
+
+    def __call__(self, r):
+        r.headers["Authorization"] = f"Bearer {self.provider.token()}"
+        return r
+
+
+def get_token_provider(directory):
+    """Process-wide provider per directory; rebuilt when its provider or credentials change."""
+    key = (directory.pk, directory.provider, json.dumps(directory.credentials or {}, sort_keys=True))
+    with _providers_lock:
+        provider = _providers.get(directory.pk)
+        if provider is None or provider.key != key:
+            cls = GoogleTokenProvider if directory.provider == "google" else AzureTokenProvider
+            provider = cls(directory)
+            provider.key = key
+            _providers[directory.pk] = provider
+        return provider
@@ -0,0 +1,7 @@
+from django.urls import path
+from . import views
+
+app_name = "directory_sync"
+urlpatterns = [
+    path("graph/notifications/", views.graph_notifications, name="graph_notifications"),
+]
@@ -1,3 +1,4 @@
+import csv
 from django.utils import timezone
 from .models import ExternalDirectory, SyncJob
 
@@ -19,6 +20,42 @@ def test_connection(directory):
     directory.save(update_fields=["last_status","last_error"])
     return ok
 
+def plan_sync(directory):
+    """Dry run: what a sync would create/update/deactivate, per field. Writes nothing."""
+    return get_syncer(directory).plan()
+
+def plan_summary(directory, plan):
+    """One line for a dry run's summary (admin message, plan command output)."""
+    s = plan["summary"]
+    fields = ", ".join(f"{k}={v}" for k, v in s["fields"].items()) or "none"
+    return (
+        f"{directory.name}: would create {s['create']}, update {s['update']} (fields: {fields}), "
+        f"deactivate {s['deactivate']}; {s['unchanged']} unchanged of {s['listed']} listed "
+        f"in {s['seconds']}s. " + " ".join(s["notes"])
+    )
+
+def synced_user_count(directory):
+    """Active local users that came from this directory's tenant/customer (how big a dry run gets)."""
+    from accounts.models import User
+    c = directory.credentials or {}
+    if directory.provider == "azure":
+        users = User.objects.filter(identity_source="AZURE", tenant_id=c.get("tenant_id"))
+    else:
+        users = User.objects.filter(identity_source="GOOGLE")
+        if c.get("domain"):
+            users = users.filter(email_domain=c["domain"].lower())
+    return users.filter(is_active=True).count()
+
+PLAN_CSV_COLUMNS = ["directory", "action", "email", "external_id", "field", "old", "new"]
+
+def write_plan_csv(out, plans):
+    """plans: iterable of (directory, plan) -> one CSV change list, a row per changed field."""
+    w = csv.writer(out)
+    w.writerow(PLAN_CSV_COLUMNS)
+    for directory, plan in plans:
+        for c in plan["changes"]:
+            w.writerow([directory.name] + [c.get(k) for k in PLAN_CSV_COLUMNS[1:]])
+
 def enqueue_run_now(directory):
     directory.next_run_at = timezone.now()
     directory.save(update_fields=["next_run_at"])
@@ -1,3 +1,53 @@
-from django.shortcuts import render
+import hmac, json
+from django.http import HttpResponse, HttpResponseBadRequest
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from .models import ExternalDirectory
+from .scheduler import request_run
 
-# Create your views here.
+
+@csrf_exempt
+@require_POST
+def graph_notifications(request):
+    """
+    Microsoft Graph change notifications for users and groups (the subscriptions are made
+    by `manage.py graph_subscriptions`; the URL must be reachable by Graph over HTTPS).
+
+    - ?validationToken=...: the handshake Graph runs when a subscription is created; the
+      token goes back unchanged as text/plain.
+    - otherwise a {"value": [notification, ...]} batch. A notification counts only if its
+      subscriptionId is one of a directory's graph_subscriptions and its clientState equals
+      that directory's notification_client_state; the rest is ignored. Each directory hit
+      gets a delta run after the debounce window (scheduler.request_run), so a burst of
+      notifications costs one run.
+
+    Always answers 202 for a well-formed batch: Graph retries anything else, and a caller
+    guessing secrets learns nothing.
+    """
+    token = request.GET.get("validationToken")
+    if token is not None:
+        return HttpResponse(token, content_type="text/plain")
+
+    try:
+        notifications = json.loads(request.body or b"{}").get("value") or []
+    except (ValueError, AttributeError):
+        return HttpResponseBadRequest("expected a Graph change notification batch")
+
+    by_subscription = {}  # subscription id -> (directory pk, clientState)
+    directories = ExternalDirectory.objects.filter(provider="azure", is_enabled=True).exclude(
+        notification_client_state="",
+    ).values_list("pk", "notification_client_state", "graph_subscriptions")
+    for pk, client_state, subscriptions in directories:
+        for sub in subscriptions or []:
+            by_subscription[sub.get("id")] = (pk, client_state)
+
+    targets = set()
+    for n in notifications:
+        if not isinstance(n, dict):
+            continue
+        pk, client_state = by_subscription.get(n.get("subscriptionId"), (None, ""))
+        if pk and hmac.compare_digest(str(n.get("clientState") or "").encode(), client_state.encode()):
+            targets.add(pk)
+    for pk in sorted(targets):
+        request_run(pk)
+    return HttpResponse(status=202)
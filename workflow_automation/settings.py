@@ -216,6 +216,9 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # seconds a write waits for SQLite's lock (the directory sync writes from the scheduler
+        # thread while requests write too) before failing with "database is locked"
+        'OPTIONS': {'timeout': 20},
     }
 }
 
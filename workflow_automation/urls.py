@@ -32,6 +32,7 @@ urlpatterns = [
     path("accounts/", include("accounts.urls", namespace="accounts")),
 
     path('', include('core.urls', namespace='core')),  # Add this
+    path("directory-sync/", include("directory_sync.urls", namespace="directory_sync")),
     path("cms/", include(wagtailadmin_urls)),  # editors here
     path("documents/", include(wagtaildocs_urls)),
     # 👇 exact /portal/ goes to entry router